@@ -3,12 +3,18 @@ import gym
 import wandb
 from deeprlyb.agents.A2C import A2C
 from deeprlyb.utils.config import read_config
+from deeprlyb.utils.env import make_vec_env
 
 
 if __name__ == "__main__":
     config = read_config()
     os.makedirs(config["PATHS"]["tensorboard_path"], exist_ok=True)
-    env = gym.make(config["GLOBAL"]["environment"])
+    env = make_vec_env(
+        config["GLOBAL"]["environment"],
+        config["GLOBAL"].getint("num_envs"),
+        config["GLOBAL"]["vectorization"],
+    )
+    test_env = gym.make(config["GLOBAL"]["environment"])
     config["GLOBAL"]["name"] = "MLP"
 
     for experiment in range(1, config["GLOBAL"].getint("n_experiments") + 1):
@@ -25,14 +31,14 @@ if __name__ == "__main__":
         comment = f"config_{experiment}"
         agent = A2C(env, config=config, comment=comment, run=run)
         if config["AGENT"]["mode"] == "MC":
-            agent.train_MC(env, config["GLOBAL"].getfloat("nb_timesteps_train"))
+            agent.train_MC(env, int(config["GLOBAL"].getfloat("nb_timesteps_train")))
         elif config["AGENT"]["mode"] == "TD0":
-            agent.train_TD0(env, config["GLOBAL"].getfloat("nb_timesteps_train"))
+            agent.train_TD0(env, int(config["GLOBAL"].getfloat("nb_timesteps_train")))
         else:
             raise ValueError(f'Agent mode {config["AGENT"]["mode"]} not recognized.')
         agent.load(f"{comment}_best")
         agent.test(
-            env,
+            test_env,
             nb_episodes=config["GLOBAL"].getint("nb_episodes_test"),
             render=config["GLOBAL"].getboolean("render"),
         )
@@ -2,6 +2,7 @@ import os
 import pickle
 import warnings
 import datetime
+from collections import defaultdict
 import gym
 import wandb
 import numpy as np
@@ -9,12 +10,22 @@ from tqdm import tqdm
 import torch
 import torch.nn as nn
 from torch.utils.tensorboard import SummaryWriter
-from typing import Dict, Tuple
+from typing import Dict, Tuple, Union
 
 # Base class for Agent
 from deeprlyb.agents.agent import Agent
-from deeprlyb.network.utils import t, compute_KL_divergence, LinearSchedule
-from deeprlyb.network.network import ActorCriticRecurrentNetworks, BaseTorchAgent
+from deeprlyb.network.utils import (
+    t,
+    a2c_losses,
+    categorical_log_prob_and_entropy,
+    compute_KL_divergence,
+    LinearSchedule,
+)
+from deeprlyb.network.network import (
+    ActorCriticRecurrentNetworks,
+    ActorCriticSharedNetwork,
+    BaseTorchAgent,
+)
 
 # Network creator tool
 from deeprlyb.utils.normalize import SimpleStandardizer
@@ -28,12 +39,6 @@ class A2C(Agent):
             self,
         ).__init__(env, config, comment, run)
 
-        self.rollout = RolloutBuffer(
-            buffer_size=config["NETWORKS"].getint("buffer_size"),
-            gamma=config["AGENT"].getfloat("gamma"),
-            n_steps=config["AGENT"].getint("n_steps"),
-        )
-
         self.obs_scaler, self.reward_scaler, self.target_scaler = self.get_scalers(
             self.config["GLOBAL"].getboolean("scaling")
         )
@@ -82,6 +87,7 @@ class A2C(Agent):
 
     def pre_train(self, env: gym.Env, nb_timestep: int, scaling=False) -> None:
         # Init training
+        nb_timestep = int(nb_timestep)
         t_old, self.constant_reward_counter = 0, 0
         actor_hidden, critic_hidden = self.actor_hidden, self.critic_hidden
         # Pre-Training
@@ -110,7 +116,6 @@ class A2C(Agent):
                 f"Obs scaler - Mean : {self.obs_scaler.mean}, std : {self.obs_scaler.std}"
             )
             print(f"Reward scaler - std : {self.reward_scaler.std}")
-            self.obs_scaler.save(path="scalers", name="obs")
             self.save_scalers("scalers", "scaler")
         return actor_hidden, critic_hidden
 
@@ -124,145 +129,290 @@ class A2C(Agent):
         self.reward_scaler.load(path, "reward_" + name)
 
     def train_MC(self, env: gym.Env, nb_timestep: int) -> None:
+        """
+        Monte-Carlo training. Each update is done on a batch of one episode per
+        environment : all environments are reset, then stepped until each of them
+        has finished its episode. Transitions of the environments that are done are
+        ignored until the whole batch is done.
+
+        Args:
+            env (gym.Env): The environment (or vector environment) to train on
+            nb_timestep (int): Number of timesteps to train for
+        """
         # actor_hidden, critic_hidden = self.pre_train(
         #     env, self.config["GLOBAL"].getfloat("learning_start")
         # )
-        actor_hidden, critic_hidden = self.actor_hidden, self.critic_hidden
-        self.rollout = RolloutBuffer(
-            buffer_size=self.env._max_episode_steps,
-            gamma=self.config["AGENT"].getfloat("gamma"),
-            n_steps=1,
-        )
+        envs = self.vectorize(env)
+        num_envs = envs.num_envs
+        gamma = self.config["AGENT"].getfloat("gamma")
         self.t, self.constant_reward_counter, self.old_reward_sum = 1, 0, 0
+        # Integer bound, compared with the integer step counter at each step
+        nb_timestep = int(nb_timestep)
         print("--- Training ---")
         t_old = 0
         pbar = tqdm(total=nb_timestep, initial=1)
         scaling = self.config["GLOBAL"].getboolean("scaling")
-        while self.t <= nb_timestep:
+        stop = False
+        # One episode buffer per environment, allocated once and reset at each batch
+        rollouts = [
+            RolloutBuffer(
+                buffer_size=self.max_episode_steps,
+                gamma=gamma,
+                n_steps=1,
+                obs_shape=self.obs_shape,
+            )
+            for _ in range(num_envs)
+        ]
+        # The values are computed by the update's critic pass : while acting, a
+        # separate critic only has to run to carry its LSTMs' hidden states
+        run_critic = self.network.shared_network or self.network.critic.recurrent
+        zero_values = np.zeros(num_envs, dtype=np.float32)
+        while self.t <= nb_timestep and not stop:
             # tqdm stuff
             pbar.update(self.t - t_old)
-            t_old, t_episode = self.t, 1
-
-            # actual episode
-            actions_taken = {action: 0 for action in range(self.action_shape)}
-            done, obs, rewards = False, env.reset(), []
-
-            reward_sum = 0
-            while not done:
-                (action, next_actor_hidden, loss_params) = self.select_action(
-                    obs, actor_hidden
-                )
-                (
-                    log_prob,
-                    entropy,
-                    KL_divergence,
-                ) = loss_params
-                value, next_critic_hidden = self.network.get_value(obs, critic_hidden)
-                next_obs, reward, done, _ = env.step(action)
-                reward_sum += reward
-
-                actions_taken[int(action)] += 1
-                self.rollout.add(reward, done, value, log_prob, entropy, KL_divergence)
+            t_old = self.t
+
+            # actual episodes
+            for rollout in rollouts:
+                rollout.reset()
+            # Number of times each action was taken, per environment
+            actions_taken = np.zeros((num_envs, self.action_shape), dtype=np.int64)
+            actor_hidden = self.network.actor.initialize_hidden_states(num_envs)
+            critic_hidden = self.network.critic.initialize_hidden_states(num_envs)
+            actor_hiddens, critic_hiddens = [], []
+            obs, reward_sums = envs.reset(), np.zeros(num_envs)
+            running = np.ones(num_envs, dtype=bool)
+            while running.any():
+                actor_hiddens.append(actor_hidden)
+                critic_hiddens.append(critic_hidden)
+                if run_critic:
+                    (
+                        action,
+                        value,
+                        actor_hidden,
+                        critic_hidden,
+                        loss_params,
+                    ) = self.network.act(obs, actor_hidden, critic_hidden)
+                else:
+                    action, actor_hidden, loss_params = self.network.select_action(
+                        obs, actor_hidden
+                    )
+                log_prob, entropy, KL_divergence = loss_params
+                # Let the environments step while the rest of the step is processed
+                envs.step_async(action)
+                # Bring the step's values back to the host in a single transfer, as an
+                # array whose elements are stored in the rollouts without conversion
+                if run_critic:
+                    value, log_prob, entropy = (
+                        torch.stack([value, log_prob, entropy]).cpu().numpy()
+                    )
+                else:
+                    value = zero_values
+                    log_prob, entropy = torch.stack([log_prob, entropy]).cpu().numpy()
+                # Stored as a plain float, like the other values of the step
+                KL_divergence = float(KL_divergence)
+                running_envs = np.flatnonzero(running)
+                actions_taken[running_envs, action[running_envs]] += 1
+                next_obs, reward, done, _ = envs.step_wait()
+
+                for i in running_envs:
+                    rollouts[i].add(
+                        reward[i],
+                        done[i],
+                        value[i],
+                        log_prob[i],
+                        entropy[i],
+                        KL_divergence,
+                        obs=obs[i],
+                        action=action[i],
+                    )
+                reward_sums += reward * running
 
-                self.t_global, self.t, t_episode = (
-                    self.t_global + 1,
-                    self.t + 1,
-                    t_episode + 1,
-                )
+                n_running = int(running.sum())
+                self.t_global, self.t = self.t_global + n_running, self.t + n_running
+                running &= ~done
                 if scaling:
                     next_obs, reward = self.scaling(
                         next_obs, reward, fit=False, transform=True
                     )
                 obs = next_obs
-                critic_hidden, actor_hidden = next_critic_hidden, next_actor_hidden
-
-            self.rollout.update_advantages(MC=True)
-            advantages = self.rollout.advantages
-            # for i in range(t_episode - 1):
-            #     loss_params_episode = (
-            #         self.rollout.log_probs[i],
-            #         self.rollout.entropies[i],
-            #         self.rollout.KL_divergences[i],
-            #     )
-            #     self.network.update_policy(
-            #         advantages[i], *loss_params_episode, finished=i == t_episode - 2
-            #     )
-            loss_params_episode = (
-                self.rollout.log_probs,
-                self.rollout.entropies,
-                self.rollout.KL_divergences,
+
+            # One update on all the episodes of the batch
+            states, actions, returns = [], [], []
+            actor_hiddens_batch, critic_hiddens_batch = [], []
+            for i, rollout in enumerate(rollouts):
+                observations, actions_episode = rollout.get_transitions()
+                length = len(actions_episode)
+                states.append(observations)
+                actions.append(actions_episode)
+                returns.append(
+                    RolloutBuffer.compute_MC_returns(rollout.rewards[:length], gamma)
+                )
+                actor_hiddens_batch.append(
+                    ActorCriticRecurrentNetworks.concatenate_hidden_states(
+                        actor_hiddens[:length], env_index=i
+                    )
+                )
+                critic_hiddens_batch.append(
+                    ActorCriticRecurrentNetworks.concatenate_hidden_states(
+                        critic_hiddens[:length], env_index=i
+                    )
+                )
+            self.network.update_policy(
+                np.concatenate(states),
+                np.concatenate(actions),
+                np.concatenate(returns),
+                ActorCriticRecurrentNetworks.concatenate_hidden_states(
+                    actor_hiddens_batch
+                ),
+                ActorCriticRecurrentNetworks.concatenate_hidden_states(
+                    critic_hiddens_batch
+                ),
             )
-            self.network.update_policy(advantages, *loss_params_episode, finished=True)
-            self.rollout.reset()
-            self.save_if_best(reward_sum)
-            if self.early_stopping(reward_sum):
-                break
 
-            self.old_reward_sum, self.episode = reward_sum, self.episode + 1
-            self.episode_logging(reward_sum, actions_taken)
+            for reward_sum, actions_episode in zip(reward_sums, actions_taken):
+                self.save_if_best(reward_sum)
+                if self.early_stopping(reward_sum):
+                    stop = True
+                    break
+
+                self.old_reward_sum, self.episode = reward_sum, self.episode + 1
+                self.episode_logging(reward_sum, actions_episode)
 
         pbar.close()
+        self.network.flush_metrics()
         self.train_logging(self.artifact)
 
     def train_TD0(self, env: gym.Env, nb_timestep: int) -> None:
+        """
+        n-step training (TD(0) for n_steps = 1). Each environment is stepped n_steps
+        times, then a single update is done on the whole rollout, with returns
+        bootstrapped on the value of the last observation. Finished environments are
+        automatically reset by the vector environment.
+
+        Args:
+            env (gym.Env): The environment (or vector environment) to train on
+            nb_timestep (int): Number of timesteps to train for
+        """
         # actor_hidden, critic_hidden = self.pre_train(
         #     env, self.config["GLOBAL"].getfloat("learning_start")
         # )
-        actor_hidden, critic_hidden = self.actor_hidden, self.critic_hidden
+        envs = self.vectorize(env)
+        num_envs = envs.num_envs
+        n_steps = self.config["AGENT"].getint("n_steps")
+        gamma = self.config["AGENT"].getfloat("gamma")
+        scaling = self.config["GLOBAL"].getboolean("scaling")
+        actor_hidden = self.network.actor.initialize_hidden_states(num_envs)
+        critic_hidden = self.network.critic.initialize_hidden_states(num_envs)
         self.constant_reward_counter, self.old_reward_sum = 0, 0
+        # Integer bound, compared with the integer step counter at each step
+        nb_timestep = int(nb_timestep)
         print("--- Training ---")
         t_old = 0
         pbar = tqdm(total=nb_timestep, initial=1)
 
-        while self.t <= nb_timestep:
+        # Number of times each action was taken, per environment
+        actions_taken = np.zeros((num_envs, self.action_shape), dtype=np.int64)
+        obs, reward_sums = envs.reset(), np.zeros(num_envs)
+        stop = False
+        # Rollout storage, allocated once. States are kept as a contiguous tensor on
+        # the network's device so that the update can use them without conversion
+        states = torch.empty(
+            (n_steps, num_envs, *self.obs_shape),
+            dtype=torch.float32,
+            device=self.network.device,
+        )
+        actions = np.empty((n_steps, num_envs), dtype=np.int64)
+        rewards = np.empty((n_steps, num_envs), dtype=np.float32)
+        dones = np.empty((n_steps, num_envs), dtype=bool)
+        # The values are computed by the update's critic pass : while acting, a
+        # separate critic only has to run to carry its LSTMs' hidden states
+        run_critic = self.network.shared_network or self.network.critic.recurrent
+        # Loop invariants of the per-step bookkeeping and of the returns, built once
+        env_indices = np.arange(num_envs)
+        zero_rewards = np.zeros((n_steps, num_envs))
+        zero_values, unit_values = np.zeros(num_envs), np.ones(num_envs)
+        while self.t <= nb_timestep and not stop:
             # tqdm stuff
             pbar.update(self.t - t_old)
-            t_old, t_episode = self.t, 1
-
-            # actual episode
-            actions_taken = {action: 0 for action in range(self.action_shape)}
-            done, obs, rewards = False, env.reset(), []
-
-            reward_sum = 0
-            while not done:
-                action, next_actor_hidden, loss_params = self.select_action(
-                    obs, actor_hidden
-                )
-                value, critic_hidden = self.network.get_value(obs, critic_hidden)
-                next_obs, reward, done, _ = env.step(action)
-                reward_sum += reward
-                if self.config["GLOBAL"].getboolean("scaling"):
+            t_old = self.t
+
+            # Rollout
+            actor_hiddens, critic_hiddens = [], []
+            for step in range(n_steps):
+                actor_hiddens.append(actor_hidden)
+                critic_hiddens.append(critic_hidden)
+                # Upload the observations once, straight into the rollout storage,
+                # and act on that tensor
+                states[step].copy_(self.network.observation_to_tensor(obs))
+                if run_critic:
+                    action, _, actor_hidden, critic_hidden, _ = self.network.act(
+                        states[step], actor_hidden, critic_hidden
+                    )
+                else:
+                    action, actor_hidden, _ = self.network.select_action(
+                        states[step], actor_hidden
+                    )
+                # Let the environments step while the transition is stored
+                envs.step_async(action)
+                actions[step] = action
+                actions_taken[env_indices, action] += 1
+                next_obs, reward, done, _ = envs.step_wait()
+                reward_sums += reward
+                if scaling:
                     next_obs, reward = self.scaling(
                         next_obs, reward, fit=False, transform=True
                     )
-                next_critic_hidden = critic_hidden.copy()
-                next_value, next_next_critic_hidden = self.network.get_value(
-                    next_obs, critic_hidden
-                )
+                rewards[step], dones[step] = reward, done
 
-                advantage = reward + next_value - value
-                actions_taken[int(action)] += 1
-
-                self.network.update_policy(advantage, *loss_params, finished=True)
-                self.t_global, self.t, t_episode = (
-                    self.t_global + 1,
-                    self.t + 1,
-                    t_episode + 1,
-                )
+                self.t_global, self.t = self.t_global + num_envs, self.t + num_envs
                 obs = next_obs
-                next_value, next_next_critic_hidden = self.network.get_value(
-                    next_obs, next_critic_hidden
+                if not done.any():
+                    continue
+                critic_hidden = self.network.critic.reset_hidden_states(
+                    critic_hidden, done
+                )
+                actor_hidden = self.network.actor.reset_hidden_states(
+                    actor_hidden, done
                 )
-                critic_hidden, actor_hidden = next_next_critic_hidden, next_actor_hidden
-
-            self.save_if_best(reward_sum)
-            if self.early_stopping(reward_sum):
-                break
 
-            self.old_reward_sum, self.episode = reward_sum, self.episode + 1
-            self.episode_logging(reward_sum, actions_taken)
+                for i in np.flatnonzero(done):
+                    self.save_if_best(reward_sums[i])
+                    if self.early_stopping(reward_sums[i]):
+                        stop = True
+                        break
+
+                    self.old_reward_sum = reward_sums[i]
+                    self.episode += 1
+                    self.episode_logging(reward_sums[i], actions_taken[i])
+                    reward_sums[i] = 0
+                    actions_taken[i] = 0
+                if stop:
+                    break
+
+            # Update on the whole rollout (flattened as step-major batches). The value
+            # of the last observations is computed by the update's critic forward
+            # pass, only the discounts it gets in each return are computed here
+            n_collected = len(actor_hiddens)
+            returns = RolloutBuffer.compute_bootstrapped_returns(
+                rewards[:n_collected], dones[:n_collected], zero_values, gamma
+            )
+            bootstrap_discounts = RolloutBuffer.compute_bootstrapped_returns(
+                zero_rewards[:n_collected], dones[:n_collected], unit_values, gamma
+            )
+            self.network.update_policy(
+                states[:n_collected].reshape(-1, *self.obs_shape),
+                actions[:n_collected].reshape(-1),
+                returns.reshape(-1),
+                ActorCriticRecurrentNetworks.concatenate_hidden_states(actor_hiddens),
+                ActorCriticRecurrentNetworks.concatenate_hidden_states(critic_hiddens),
+                last_states=obs,
+                last_hidden=critic_hidden,
+                bootstrap_discounts=bootstrap_discounts.reshape(-1),
+            )
 
         pbar.close()
+        self.network.flush_metrics()
         self.train_logging(self.artifact)
 
     def test(
@@ -281,8 +431,9 @@ class A2C(Agent):
             with open(scaler_file, "rb") as input_file:
                 scaler = pickle.load(input_file)
             self.obs_scaler = scaler
-        episode_rewards = []
+        episode_rewards = np.empty(nb_episodes)
         best_test_episode_reward = 0
+        scaling = self.config["GLOBAL"].getboolean("scaling")
         # Iterate over the episodes
         for episode in tqdm(range(nb_episodes)):
             actor_hidden = self.network.actor.initialize_hidden_states()
@@ -292,7 +443,7 @@ class A2C(Agent):
             # Generate episode
             while not done:
                 # Select the action using the current policy
-                if self.config["GLOBAL"].getboolean("scaling"):
+                if scaling:
                     obs = self.obs_scaler.transform(obs)
                 action, next_actor_hidden, _ = self.select_action(obs, actor_hidden)
 
@@ -321,61 +472,69 @@ class A2C(Agent):
             elif self.config["GLOBAL"]["logging"] == "tensorboard":
                 self.network.writer.add_scalar("Reward/test", rewards_sum, episode)
             # print(f"test number {episode} : {rewards_sum}")
-            episode_rewards.append(rewards_sum)
+            episode_rewards[episode] = rewards_sum
         env.close()
         if self.config["GLOBAL"]["logging"] == "tensorboard":
             self.network.writer.add_hparams(
-                self.config,
                 {
-                    "test mean reward": np.mean(episode_rewards),
-                    "test std reward": np.std(episode_rewards),
-                    "test max reward": max(episode_rewards),
-                    "min test reward": min(episode_rewards),
+                    f"{section}/{key}": value
+                    for section in self.config.sections()
+                    for key, value in self.config[section].items()
+                },
+                {
+                    "test mean reward": episode_rewards.mean(),
+                    "test std reward": episode_rewards.std(),
+                    "test max reward": episode_rewards.max(),
+                    "min test reward": episode_rewards.min(),
                 },
                 run_name="test",
             )
 
-    def _learn(self) -> None:
-        for i, steps in enumerate(self.rollout.get_steps_list()):
-            advantage, log_prob, entropy, kl_divergence = steps
-            self.network.update_policy(
-                advantage,
-                log_prob,
-                entropy,
-                kl_divergence,
-                finished=True,
-            )
-
 
 class TorchA2C(BaseTorchAgent):
     def __init__(self, agent) -> None:
         super(TorchA2C, self).__init__(agent)
 
-        self.actor = ActorCriticRecurrentNetworks(
-            agent.obs_shape[0],
-            agent.action_shape,
-            self.config["NETWORKS"]["actor_nn_architecture"],
-            actor=True,
-            activation=self.config["NETWORKS"]["actor_activation_function"],
-        )
+        self.shared_network = self.config["NETWORKS"].getboolean("shared_network")
+        if self.shared_network:
+            # The actor and the critic are the two heads of the same network, which
+            # uses the actor's architecture and is trained with a single optimizer
+            self.actor = self.critic = ActorCriticSharedNetwork(
+                agent.obs_shape[0],
+                agent.action_shape,
+                self.config["NETWORKS"]["actor_nn_architecture"],
+                activation=self.config["NETWORKS"]["actor_activation_function"],
+            )
+            self.actor_optimizer = self.critic_optimizer = torch.optim.Adam(
+                self.actor.parameters(),
+                lr=self.config["NETWORKS"].getfloat("learning_rate"),
+            )
+        else:
+            self.actor = ActorCriticRecurrentNetworks(
+                agent.obs_shape[0],
+                agent.action_shape,
+                self.config["NETWORKS"]["actor_nn_architecture"],
+                actor=True,
+                activation=self.config["NETWORKS"]["actor_activation_function"],
+            )
 
-        self.critic = ActorCriticRecurrentNetworks(
-            agent.obs_shape[0],
-            1,
-            self.config["NETWORKS"]["critic_nn_architecture"],
-            actor=False,
-            activation=self.config["NETWORKS"]["critic_activation_function"],
-        )
+            self.critic = ActorCriticRecurrentNetworks(
+                agent.obs_shape[0],
+                1,
+                self.config["NETWORKS"]["critic_nn_architecture"],
+                actor=False,
+                activation=self.config["NETWORKS"]["critic_activation_function"],
+            )
 
-        # Optimize to use for weight update (SGD seems to work poorly, switching to RMSProp) given our learning rate
-        self.actor_optimizer = torch.optim.Adam(
-            self.actor.parameters(),
-            lr=self.config["NETWORKS"].getfloat("learning_rate"),
-        )
-        self.critic_optimizer = torch.optim.Adam(
-            self.critic.parameters(),
-            lr=self.config["NETWORKS"].getfloat("learning_rate_critic"),
-        )
+            # Optimize to use for weight update (SGD seems to work poorly, switching to RMSProp) given our learning rate
+            self.actor_optimizer = torch.optim.Adam(
+                self.actor.parameters(),
+                lr=self.config["NETWORKS"].getfloat("learning_rate"),
+            )
+            self.critic_optimizer = torch.optim.Adam(
+                self.critic.parameters(),
+                lr=self.config["NETWORKS"].getfloat("learning_rate_critic"),
+            )
 
         self.target_var_scaler = SimpleStandardizer()
         self.advantages_var_scaler = SimpleStandardizer()
@@ -384,6 +543,24 @@ class TorchA2C(BaseTorchAgent):
             self.config["NETWORKS"].getfloat("learning_rate_end"),
             self.config["GLOBAL"].getfloat("nb_timesteps_train"),
         )
+        # Anomaly detection checks every autograd operation, only use it to debug
+        if self.config["GLOBAL"].getboolean("debug", fallback=False):
+            torch.autograd.set_detect_anomaly(True)
+        hardware = self.config["HARDWARE"]
+        if hardware.getboolean("jit") or hardware.getboolean("compile", fallback=False):
+            self.to(self.device)
+            self.jit_compile()
+        # Settings of the update, read once rather than on every update
+        self.entropy_factor = self.config["AGENT"].getfloat("entropy_factor")
+        self.KL_factor = self.config["AGENT"].getfloat("KL_factor", fallback=0.0)
+        self.clip_value = self.config["AGENT"].getfloat("gradient_clipping")
+        self.logging = self.config["GLOBAL"]["logging"].lower()
+        self.log_every = self.config["GLOBAL"].getint("log_every", fallback=100)
+        self.metrics = defaultdict(list)
+        self.value_factor = self.config["AGENT"].getfloat("value_factor")
+        self.normalize_advantages = self.config["NETWORKS"].getboolean(
+            "normalize_advantages"
+        )
         # Init stuff
         self.loss = None
         self.epoch = 0
@@ -397,79 +574,182 @@ class TorchA2C(BaseTorchAgent):
         self.targets = []
 
     def select_action(
-        self, observation: np.ndarray, hidden: Dict[int, torch.Tensor]
+        self,
+        observation: Union[np.ndarray, torch.Tensor],
+        hidden: Dict[int, torch.Tensor],
     ) -> np.ndarray:
-        probs, new_hidden = self.actor(t(observation), hidden)
-        dist = torch.distributions.Categorical(probs=probs)
-        action = dist.sample()
+        # Acting doesn't need gradients : the batch is re-evaluated in update_policy
+        with torch.inference_mode():
+            observation_tensor = self.observation_to_tensor(observation)
+            if self.shared_network:
+                probs, _, new_hidden = self.actor(observation_tensor, hidden)
+            else:
+                probs, new_hidden = self.actor(observation_tensor, hidden)
+            action, loss_params = self.sample_action(probs, observation.shape[:-1])
+        return action, new_hidden, loss_params
+
+    def act(
+        self,
+        observation: Union[np.ndarray, torch.Tensor],
+        actor_hidden: Dict[int, torch.Tensor],
+        critic_hidden: Dict[int, torch.Tensor],
+    ) -> Tuple[
+        np.ndarray,
+        torch.Tensor,
+        Dict[int, torch.Tensor],
+        Dict[int, torch.Tensor],
+        Tuple[torch.Tensor, torch.Tensor, float],
+    ]:
+        """
+        Select the actions and compute the values of the observations. With a shared
+        network, a single forward pass gives both.
+
+        Args:
+            observation (Union[np.ndarray, torch.Tensor]): The observations, of shape (*batch_shape, *obs_shape). Tensors are used without conversion
+            actor_hidden (Dict[int, torch.Tensor]): Hidden states of the actor
+            critic_hidden (Dict[int, torch.Tensor]): Hidden states of the critic (ignored with a shared network)
+
+        Returns:
+            Tuple[np.ndarray, torch.Tensor, Dict[int, torch.Tensor], Dict[int, torch.Tensor], Tuple[torch.Tensor, torch.Tensor, float]]: The actions, the values, the new actor and critic hidden states and the loss parameters (log-probabilities, entropies and KL divergence)
+        """
+        if not self.shared_network:
+            action, actor_hidden, loss_params = self.select_action(
+                observation, actor_hidden
+            )
+            value, critic_hidden = self.get_value(observation, critic_hidden)
+            return action, value, actor_hidden, critic_hidden, loss_params
+        with torch.inference_mode():
+            observation_tensor = self.observation_to_tensor(observation)
+            probs, value, new_hidden = self.actor(observation_tensor, actor_hidden)
+            action, loss_params = self.sample_action(probs, observation.shape[:-1])
+        return (
+            action,
+            value.reshape(observation.shape[:-1]),
+            new_hidden,
+            new_hidden,
+            loss_params,
+        )
+
+    def sample_action(
+        self, probs: torch.Tensor, batch_shape: tuple
+    ) -> Tuple[Union[int, np.ndarray], Tuple[torch.Tensor, torch.Tensor, float]]:
+        probs = probs.reshape(-1, probs.shape[-1])
+        action = torch.multinomial(probs, num_samples=1).squeeze(-1)
 
-        log_prob = dist.log_prob(action.detach())
-        entropy = dist.entropy()
+        log_prob, entropy = categorical_log_prob_and_entropy(probs, action)
 
-        if self.old_dist is not None:
-            KL_divergence = compute_KL_divergence(self.old_dist, dist)
+        # The KL divergence is only worth computing when it weighs in the loss
+        if self.KL_factor > 0 and self.old_dist is not None:
+            KL_divergence = compute_KL_divergence(
+                self.old_dist, torch.distributions.Categorical(probs=probs)
+            )
         else:
             KL_divergence = 0
-        action = action.flatten()[0]
+        # One action per observation : an int for a single observation, a
+        # (num_envs,) array for a batch of observations
         return (
-            action.detach().data.numpy(),
-            new_hidden,
-            (log_prob, entropy, KL_divergence),
+            action.item()
+            if batch_shape == ()
+            else action.reshape(batch_shape).cpu().numpy(),
+            (
+                log_prob.reshape(batch_shape),
+                entropy.reshape(batch_shape),
+                KL_divergence,
+            ),
         )
 
     def update_policy(
         self,
-        advantages: torch.Tensor,
-        log_prob: torch.Tensor,
-        entropy: torch.Tensor,
-        kl_divergence: torch.Tensor,
-        finished: bool = False,
+        states: Union[np.ndarray, torch.Tensor],
+        actions: np.ndarray,
+        returns: np.ndarray,
+        actor_hiddens: Dict[int, torch.Tensor] = None,
+        critic_hiddens: Dict[int, torch.Tensor] = None,
+        last_states: np.ndarray = None,
+        last_hidden: Dict[int, torch.Tensor] = None,
+        bootstrap_discounts: np.ndarray = None,
     ) -> None:
         """
-        Update the policy's parameters according to the n-step A2C updates rules. see : https://medium.com/deeplearningmadeeasy/advantage-actor-critic-a2c-implementation-944e98616b
+        Update the policy's parameters according to the A2C updates rules, on a whole batch of transitions at once (one forward and one backward pass per network). see : https://medium.com/deeplearningmadeeasy/advantage-actor-critic-a2c-implementation-944e98616b
 
 
         Args:
-            state (np.array): Observation of the state
-            action (np.array): The selected action
-            n_step_return (np.array): The n-step return
-            next_state (np.array): The state n-step after state
-            done (bool, optional): Wether the episode if finished or not at next-state. Used to handle 1-step. Defaults to False.
+            states (Union[np.ndarray, torch.Tensor]): Observations of the batch, of shape (batch_size, *obs_shape). Float32 tensors on the network's device are used as is
+            actions (np.ndarray): The selected actions, of shape (batch_size,)
+            returns (np.ndarray): The (n-step or MC) returns used as targets for the critic, of shape (batch_size,)
+            actor_hiddens (Dict[int, torch.Tensor], optional): Hidden states of the actor's LSTMs before each transition, batched along the batch dimension. Defaults to initial hidden states.
+            critic_hiddens (Dict[int, torch.Tensor], optional): Same for the critic. Defaults to initial hidden states.
+            last_states (np.ndarray, optional): Observations following the rollout, of shape (num_envs, *obs_shape). If given, their values are computed in the same critic forward pass as the batch and added to the returns, weighted by bootstrap_discounts. Defaults to None (returns used as is).
+            last_hidden (Dict[int, torch.Tensor], optional): Hidden states of the critic (or of the shared network) for the last observations. Defaults to initial hidden states.
+            bootstrap_discounts (np.ndarray, optional): Discount of the value of the last observation of its environment in each return, of shape (batch_size,), ordered step-major like the batch. Defaults to None.
         """
 
         # For logging purposes
-        torch.autograd.set_detect_anomaly(True)
         self.index += 1
-        if self.config["NETWORKS"].getboolean("normalize_advantages"):
-            advantages = torch.div(
-                torch.sub(advantages, advantages.mean()),
-                torch.add(advantages.std(), 1e-8),
+        batch_size = len(actions)
+        if actor_hiddens is None:
+            actor_hiddens = self.actor.initialize_hidden_states(batch_size)
+        if critic_hiddens is None:
+            critic_hiddens = self.critic.initialize_hidden_states(batch_size)
+
+        # Convert the batch once, the actor and the critic share the states tensor
+        states = self.to_tensor(states)
+        critic_states = states
+        if last_states is not None:
+            # Values of the batch and of the bootstrap observations in one pass
+            if last_hidden is None:
+                last_hidden = self.critic.initialize_hidden_states(len(last_states))
+            critic_states = torch.cat([states, self.to_tensor(last_states)])
+            critic_hiddens = ActorCriticRecurrentNetworks.concatenate_hidden_states(
+                [actor_hiddens if self.shared_network else critic_hiddens, last_hidden]
             )
+        if self.shared_network:
+            probs, values, _ = self.actor(critic_states, critic_hiddens)
+        else:
+            probs, _ = self.actor(states, actor_hiddens)
+            values, _ = self.critic(critic_states, critic_hiddens)
+        probs = probs.reshape(-1, probs.shape[-1])[:batch_size]
+        log_prob, entropy = categorical_log_prob_and_entropy(
+            probs, torch.as_tensor(actions, device=self.device)
+        )
+        values = values.reshape(-1)
+
+        returns = self.to_tensor(returns)
+        if last_states is not None:
+            last_values = values[batch_size:].detach()
+            returns = returns + self.to_tensor(
+                bootstrap_discounts
+            ) * last_values.repeat(batch_size // len(last_values))
+        values = values[:batch_size]
 
         # Losses (be careful that all its components are torch tensors with grad on)
-        entropy_loss = -entropy.mean()
-        try:
-            actor_loss = -(log_prob * advantages).mean()
-        except Exception as e:
-            print("exception is", e)
-        critic_loss = advantages.pow(2).mean()
-        kl_loss = -kl_divergence
-        actor_loss = (
-            actor_loss
-            + self.config["AGENT"].getfloat("entropy_factor") * entropy_loss
-            # + self.config["AGENT"].getfloat("KL_factor") * kl_loss
+        actor_loss, critic_loss, entropy_loss = a2c_losses(
+            log_prob,
+            entropy,
+            values,
+            returns,
+            self.entropy_factor,
+            self.normalize_advantages,
         )
-        self.actor_optimizer.zero_grad()
-        actor_loss.backward(retain_graph=True)
-        self.gradient_clipping()
-        if finished:
+        if self.shared_network:
+            # Single backward pass through the shared layers
+            loss = actor_loss + self.value_factor * critic_loss
+            self.actor_optimizer.zero_grad()
+            loss.backward()
+            self.gradient_clipping()
+            self.actor_optimizer.step()
+        else:
+            # The advantages are detached, so the actor and critic graphs are
+            # independent and each can be freed by its own backward pass
+            self.actor_optimizer.zero_grad()
+            actor_loss.backward()
+            self.gradient_clipping()
             self.actor_optimizer.step()
 
-        self.critic_optimizer.zero_grad()
-        critic_loss.backward(retain_graph=True)
+            self.critic_optimizer.zero_grad()
+            critic_loss.backward()
 
-        self.gradient_clipping()
-        if finished:
+            self.gradient_clipping()
             self.critic_optimizer.step()
 
         # KPIs
@@ -479,33 +759,58 @@ class TorchA2C(BaseTorchAgent):
         # )
         # self.old_dist = dist
 
-        # Logging
+        # Logging : the losses are kept on device and averaged every log_every updates,
+        # rather than synchronized and written at each update
+        if self.logging in ("tensorboard", "wandb"):
+            self.metrics["entropy"].append(-entropy_loss.detach())
+            self.metrics["actor loss"].append(actor_loss.detach())
+            self.metrics["critic loss"].append(critic_loss.detach())
+            if self.index % self.log_every == 0:
+                self.flush_metrics()
 
-        if self.config["GLOBAL"]["logging"].lower() == "tensorboard":
+    def flush_metrics(self) -> None:
+        """
+        Log the averages of the losses accumulated since the last flush
+        """
+        if not self.metrics:
+            return
+        means = {
+            name: torch.stack(values).mean().item()
+            for name, values in self.metrics.items()
+        }
+        self.metrics.clear()
+        learning_rate = self.lr_scheduler.transform(self.index)
+        if self.logging == "tensorboard":
             if self.writer:
-                self.writer.add_scalar("Train/entropy loss", -entropy_loss, self.index)
+                self.writer.add_scalar(
+                    "Train/entropy loss", means["entropy"], self.index
+                )
                 self.writer.add_scalar(
                     "Train/leaarning rate",
-                    self.lr_scheduler.transform(self.index),
+                    learning_rate,
                     self.index,
                 )
-                self.writer.add_scalar("Train/policy loss", actor_loss, self.index)
-                self.writer.add_scalar("Train/critic loss", critic_loss, self.index)
+                self.writer.add_scalar(
+                    "Train/policy loss", means["actor loss"], self.index
+                )
+                self.writer.add_scalar(
+                    "Train/critic loss", means["critic loss"], self.index
+                )
                 # self.writer.add_scalar(
                 #     "Train/explained variance", explained_variance, self.index
                 # )
                 # self.writer.add_scalar("Train/kl divergence", KL_divergence, self.index)
             else:
                 warnings.warn("No Tensorboard writer available")
-        elif self.config["GLOBAL"]["logging"].lower() == "wandb":
+        elif self.logging == "wandb":
             wandb.log(
                 {
-                    "Train/entropy loss": -entropy_loss,
-                    "Train/actor loss": actor_loss,
-                    "Train/critic loss": critic_loss,
+                    "Train/entropy loss": means["entropy"],
+                    "Train/actor loss": means["actor loss"],
+                    "Train/critic loss": means["critic loss"],
                     # "Train/explained variance": explained_variance,
                     # "Train/KL divergence": KL_divergence,
-                    "Train/learning rate": self.lr_scheduler.transform(self.index),
+                    "Train/learning rate": learning_rate,
                 },
                 commit=False,
             )
@@ -538,8 +843,13 @@ class TorchA2C(BaseTorchAgent):
         Returns:
             np.array: np.array representation of the action probabilities
         """
-        value, new_hidden = self.critic(t(state), hidden)
-        return value, new_hidden
+        with torch.inference_mode():
+            state_tensor = self.observation_to_tensor(state)
+            if self.shared_network:
+                _, value, new_hidden = self.critic(state_tensor, hidden)
+            else:
+                value, new_hidden = self.critic(state_tensor, hidden)
+        return value.reshape(state.shape[:-1]), new_hidden
 
     def save(self, name: str = "model") -> None:
         """
@@ -564,9 +874,29 @@ class TorchA2C(BaseTorchAgent):
         self.actor = torch.load(
             f'{self.config["PATHS"]["model_path"]}/{name}_actor.pth'
         )
-        self.critic = torch.load(
-            f'{self.config["PATHS"]["model_path"]}/{name}_critic.pth'
+        if self.shared_network:
+            self.critic = self.actor
+        else:
+            self.critic = torch.load(
+                f'{self.config["PATHS"]["model_path"]}/{name}_critic.pth'
+            )
+        hardware = self.config["HARDWARE"]
+        if hardware.getboolean("jit") or hardware.getboolean("compile", fallback=False):
+            self.jit_compile()
+
+    def jit_compile(self) -> None:
+        """
+        Compile the actor and the critic for acting, with torch.compile if
+        HARDWARE/compile is set, with TorchScript otherwise
+        """
+        backend = (
+            "compile"
+            if self.config["HARDWARE"].getboolean("compile", fallback=False)
+            else "script"
         )
+        self.actor.jit_compile(backend)
+        if self.critic is not self.actor:
+            self.critic.jit_compile(backend)
 
     def fit_transform(self, input) -> torch.Tensor:
         self.scaler.partial_fit(input)
@@ -574,10 +904,9 @@ class TorchA2C(BaseTorchAgent):
             return t(self.scaler.transform(input))
 
     def gradient_clipping(self) -> None:
-        clip_value = self.config["AGENT"].getfloat("gradient_clipping")
-        if clip_value is not None:
+        if self.clip_value is not None:
             for optimizer in [self.actor_optimizer, self.critic_optimizer]:
                 nn.utils.clip_grad_norm_(
                     [p for g in optimizer.param_groups for p in g["params"]],
-                    clip_value,
+                    self.clip_value,
                 )
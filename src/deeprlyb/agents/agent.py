@@ -8,6 +8,7 @@ import numpy as np
 from deeprlyb.utils.normalize import (
     SimpleStandardizer,
 )
+from deeprlyb.utils.env import make_vec_env
 from typing import Tuple
 
 
@@ -25,6 +26,12 @@ class Agent:
         # For logging purpose
         self.log_dir = self.create_dirs()
         self.best_episode_reward, self.episode = -np.inf, 1
+        # Scratch buffer for scaling scalar rewards without allocating
+        self._reward_buf = np.empty(1, dtype=np.float32)
+        # Preallocated float32 outputs of the scalers, one per (name, shape)
+        self._scaling_buffers = {}
+        # Vector environments created by vectorize, reused across training calls
+        self._vector_envs = {}
 
     @property
     def config(self) -> dict:
@@ -43,18 +50,83 @@ class Agent:
         else:
             raise ValueError("Environment spaces don't match. Check new environment.")
 
+    @property
+    def num_envs(self) -> int:
+        return self.env.num_envs if isinstance(self.env, gym.vector.VectorEnv) else 1
+
+    @property
+    def observation_space(self) -> gym.Space:
+        if isinstance(self.env, gym.vector.VectorEnv):
+            return self.env.single_observation_space
+        return self.env.observation_space
+
+    @property
+    def action_space(self) -> gym.Space:
+        if isinstance(self.env, gym.vector.VectorEnv):
+            return self.env.single_action_space
+        return self.env.action_space
+
     @property
     def obs_shape(self) -> tuple:
-        return self.env.observation_space.shape
+        return self.observation_space.shape
 
     @property
     def action_shape(self) -> int:
         return (
-            self.env.action_space.shape[0]
+            self.action_space.shape[0]
             if self.config["GLOBAL"].getboolean("continuous")
-            else self.env.action_space.n
+            else self.action_space.n
         )
 
+    @property
+    def max_episode_steps(self) -> int:
+        if isinstance(self.env, gym.vector.VectorEnv):
+            return gym.spec(self.config["GLOBAL"]["environment"]).max_episode_steps
+        return self.env._max_episode_steps
+
+    def vectorize(self, env: gym.Env) -> gym.vector.VectorEnv:
+        """
+        Wrap a single environment into a vector environment so that the training loops
+        always deal with batched observations, rewards and dones. The environment is
+        stepped alongside GLOBAL/num_envs - 1 copies made from its spec, or replaced by
+        num_envs subprocess copies with GLOBAL/vectorization = async. Vector
+        environments are returned untouched. The vector environment is created once
+        per environment and settings, then reused until closed (see close).
+
+        Args:
+            env (gym.Env): The environment to wrap
+
+        Returns:
+            gym.vector.VectorEnv: The (batched) environment
+        """
+        if isinstance(env, gym.vector.VectorEnv):
+            return env
+        num_envs = self.config["GLOBAL"].getint("num_envs", fallback=1)
+        vectorization = self.config["GLOBAL"].get("vectorization", "sync")
+        key = (env, num_envs, vectorization)
+        envs = self._vector_envs.get(key)
+        if envs is not None and not envs.closed:
+            return envs
+        if vectorization == "async":
+            envs = make_vec_env(env.spec.id, num_envs, "async")
+        else:
+            env_fns = [lambda: env] + [
+                lambda: gym.make(env.spec.id) for _ in range(num_envs - 1)
+            ]
+            envs = gym.vector.SyncVectorEnv(env_fns)
+        self._vector_envs[key] = envs
+        return envs
+
+    def close(self) -> None:
+        """
+        Close the vector environments created by vectorize (stopping the subprocesses
+        of the asynchronous ones).
+        """
+        for envs in self._vector_envs.values():
+            if not envs.closed:
+                envs.close()
+        self._vector_envs = {}
+
     @abstractmethod
     def select_action(self, observation) -> NotImplementedError:
         raise NotImplementedError
@@ -108,13 +180,10 @@ class Agent:
             self.constant_reward_counter = 0
         return False
 
-    def episode_logging(self, reward_sum: float, actions_taken: dict) -> None:
-        n_actions = sum(actions_taken.values())
-        action_frequencies = {
-            action: n / n_actions for action, n in actions_taken.items()
-        }
+    def episode_logging(self, reward_sum: float, actions_taken: np.ndarray) -> None:
+        action_frequencies = actions_taken / actions_taken.sum()
         if self.config["GLOBAL"]["logging"].lower() == "wandb":
-            for action, frequency in action_frequencies.items():
+            for action, frequency in enumerate(action_frequencies):
                 wandb.log(
                     {
                         f"Actions/{action}": frequency,
@@ -138,14 +207,51 @@ class Agent:
     def scaling(
         self, obs: np.ndarray, reward: float, fit: bool = True, transform: bool = True
     ) -> Tuple[np.ndarray, float]:
-        # Scaling
+        # Scalar rewards (single env) go through the scratch buffer, batched rewards
+        # (vector env) are scaled as is
+        scalar_reward = np.ndim(reward) == 0
+        if scalar_reward:
+            self._reward_buf[0] = reward
+            reward = self._reward_buf
+        # Scaling, in a single pass over the values when both fitting and transforming
+        if fit and transform:
+            reward = self.reward_scaler.partial_fit_transform(
+                reward, out=self.scaling_buffer("reward", reward.shape)
+            )
+            obs = self.obs_scaler.partial_fit_transform(
+                obs, out=self.scaling_buffer("obs", obs.shape)
+            )
+            return obs, float(reward[0]) if scalar_reward else reward
         if fit:
             self.obs_scaler.partial_fit(obs)
-            self.reward_scaler.partial_fit(np.array([reward]))
+            self.reward_scaler.partial_fit(reward)
         if transform:
-            reward = self.reward_scaler.transform(np.array([reward]))[0]
-            obs = self.obs_scaler.transform(obs)
-        return obs, reward
+            # Written into preallocated arrays, overwritten by the next call
+            reward = self.reward_scaler.transform(
+                reward, out=self.scaling_buffer("reward", reward.shape)
+            )
+            obs = self.obs_scaler.transform(
+                obs, out=self.scaling_buffer("obs", obs.shape)
+            )
+        return obs, float(reward[0]) if scalar_reward else reward
+
+    def scaling_buffer(self, name: str, shape: tuple) -> np.ndarray:
+        """
+        Get the preallocated float32 array the scaled values of the given name and
+        shape are written in.
+
+        Args:
+            name (str): Name of the scaled values (e.g. "obs")
+            shape (tuple): Shape of the scaled values
+
+        Returns:
+            np.ndarray: The preallocated array
+        """
+        buffer = self._scaling_buffers.get((name, shape))
+        if buffer is None:
+            buffer = np.empty(shape, dtype=np.float32)
+            self._scaling_buffers[(name, shape)] = buffer
+        return buffer
 
     def create_dirs(self) -> None:
         today = date.today().strftime("%d-%m-%Y")
@@ -186,10 +292,8 @@ class Agent:
 
             if self.obs_scaler is not None:
                 artifact = wandb.Artifact(f"{self.comment}_obs_scaler", type="scaler")
-                pickle.dump(
-                    self.obs_scaler,
-                    open(f"data/{self.comment}_obs_scaler.pkl", "wb"),
-                )
+                with open(f"data/{self.comment}_obs_scaler.pkl", "wb") as file:
+                    pickle.dump(self.obs_scaler, file, protocol=pickle.HIGHEST_PROTOCOL)
                 artifact.add_file(f"data/{self.comment}_obs_scaler.pkl")
 
                 # Save the artifact version to W&B and mark it as the output of this run
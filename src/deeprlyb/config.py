@@ -17,12 +17,12 @@ config = {
     # General
     "AGENT": "n-steps A2C",
     "GAMMA": 0.99,
-    "NB_TIMESTEPS_TRAIN": 1e4,
+    "NB_TIMESTEPS_TRAIN": 10_000,
     "NB_EPISODES_TEST": 1,
     "VALUE_FACTOR": 0.5,
     "ENTROPY_FACTOR": 0,
     "KL_FACTOR": 0.0000,
-    "LEARNING_START": 1e3,
+    "LEARNING_START": 1_000,
     # Specific
     "N_STEPS": 1,
     # NETWORKS
@@ -1,16 +1,26 @@
+import warnings
 from abc import abstractmethod
-from typing import Tuple, Dict
+from typing import Tuple, Dict, List, Union
 
+import numpy as np
 
 # PyTorch
 import torch
 import torch.nn as nn
 
 # Network creator tool
-from deeprlyb.network.utils import get_network_from_architecture, get_device
+from deeprlyb.network.utils import (
+    get_network_from_architecture,
+    get_layers_from_architecture,
+    get_activation_function,
+    get_device,
+    init_weights,
+)
 
 
 ZERO = 1e-7
+# Hidden states of the LSTM layers, indexed by the position of the layer
+Hiddens = Dict[int, Tuple[torch.Tensor, torch.Tensor]]
 
 
 class BaseTorchAgent(nn.Module):
@@ -18,6 +28,13 @@ class BaseTorchAgent(nn.Module):
         super(BaseTorchAgent, self).__init__()
         self._agent = agent
         self.device = get_device(self.config["HARDWARE"]["device"])
+        if self.device.type == "cuda":
+            # Let cuDNN pick the fastest kernels for the (few) input shapes used
+            torch.backends.cudnn.benchmark = True
+        # Preallocated observation tensors, one per observation shape (plus pinned
+        # host tensors to upload them asynchronously when running on GPU)
+        self._observation_buffers = {}
+        self._pinned_observation_buffers = {}
 
     @property
     def env(self):
@@ -35,6 +52,58 @@ class BaseTorchAgent(nn.Module):
     def config(self):
         return self._agent.config
 
+    def to_tensor(self, x: np.ndarray) -> torch.Tensor:
+        """
+        Convert an array to a float32 tensor on the network's device, without copying
+        when it already is one.
+
+        Args:
+            x (np.ndarray): The array to convert
+
+        Returns:
+            torch.Tensor: The corresponding tensor
+        """
+        return torch.as_tensor(x, dtype=torch.float32, device=self.device)
+
+    def observation_to_tensor(
+        self, observation: Union[np.ndarray, torch.Tensor]
+    ) -> torch.Tensor:
+        """
+        Convert observations to a float32 tensor on the network's device. Tensors
+        already on the device and float32 observations on CPU are shared without
+        copy, others are copied into a preallocated tensor instead of allocating a new
+        one at each step. The returned tensor is overwritten by the next call.
+
+        Args:
+            observation (Union[np.ndarray, torch.Tensor]): The observations to convert
+
+        Returns:
+            torch.Tensor: The corresponding tensor
+        """
+        if isinstance(observation, torch.Tensor):
+            return self.to_tensor(observation)
+        observation = np.asarray(observation)
+        if observation.dtype == np.float32 and self.device.type == "cpu":
+            return torch.from_numpy(observation)
+        buffer = self._observation_buffers.get(observation.shape)
+        if buffer is None:
+            # Normal tensors, so that they can be written both in and out of inference
+            # mode
+            with torch.inference_mode(False):
+                buffer = torch.empty(
+                    observation.shape, dtype=torch.float32, device=self.device
+                )
+                if self.device.type == "cuda":
+                    self._pinned_observation_buffers[observation.shape] = torch.empty(
+                        observation.shape, dtype=torch.float32
+                    ).pin_memory()
+            self._observation_buffers[observation.shape] = buffer
+        if self.device.type == "cuda":
+            pinned_buffer = self._pinned_observation_buffers[observation.shape]
+            pinned_buffer.numpy()[...] = observation
+            return buffer.copy_(pinned_buffer, non_blocking=True)
+        return buffer.copy_(torch.from_numpy(observation))
+
     @abstractmethod
     def select_action(self):
         pass
@@ -52,6 +121,61 @@ class BaseTorchAgent(nn.Module):
         pass
 
 
+class FeedForwardBlock(nn.Module):
+    """
+    Consecutive feed-forward layers, with the signature of a recurrent block so that
+    both can be chained in a scripted network.
+    """
+
+    def __init__(self, layers: List[nn.Module]):
+        super(FeedForwardBlock, self).__init__()
+        self.layers = nn.Sequential(*layers)
+
+    def forward(self, input: torch.Tensor, hiddens: Hiddens) -> torch.Tensor:
+        return self.layers(input)
+
+
+class RecurrentBlock(nn.Module):
+    """
+    LSTM layer reading and writing its hidden state in the hidden states dict, under
+    the index of the layer in the network.
+    """
+
+    def __init__(self, lstm: nn.LSTM, index: int):
+        super(RecurrentBlock, self).__init__()
+        self.lstm = lstm
+        self.index = index
+        self.input_size = lstm.input_size
+
+    def forward(self, input: torch.Tensor, hiddens: Hiddens) -> torch.Tensor:
+        input = input.view(-1, 1, self.input_size)
+        input, hidden = self.lstm(input, hiddens[self.index])
+        hiddens[self.index] = hidden
+        return input
+
+
+class BlockNetwork(nn.Module):
+    """
+    Chain of feed-forward and recurrent blocks, that can be compiled with
+    torch.jit.script or torch.compile.
+    """
+
+    def __init__(self, blocks: List[nn.Module]):
+        super(BlockNetwork, self).__init__()
+        self.blocks = nn.ModuleList(blocks)
+
+    def forward(
+        self, input: torch.Tensor, hiddens: Hiddens
+    ) -> Tuple[torch.Tensor, Hiddens]:
+        # The recurrent blocks write in a copy, the given hidden states being kept
+        # (e.g. as the snapshots of a rollout). Scripting copied the dict anyway, but
+        # torch.compile would otherwise mutate and return the caller's dict
+        hiddens = hiddens.copy()
+        for block in self.blocks:
+            input = block(input, hiddens)
+        return input, hiddens
+
+
 class ActorCriticRecurrentNetworks(nn.Module):
     """
     TBRD
@@ -72,6 +196,7 @@ class ActorCriticRecurrentNetworks(nn.Module):
         self.actor = actor
         self.activation = activation
         self.network = self.init_layers()
+        self.compiled_network = None
         print("actor" if actor else "critic", self.network)
 
     @property
@@ -94,15 +219,127 @@ class ActorCriticRecurrentNetworks(nn.Module):
     def num_layers(self):
         return self._num_layers
 
-    def initialize_hidden_states(self):
+    @property
+    def recurrent(self) -> bool:
+        return any(
+            isinstance(layer, torch.nn.modules.rnn.LSTM) for layer in self.network
+        )
+
+    def jit_compile(self, backend: str = "script") -> None:
+        """
+        Compile the layers to cut the eager-mode overhead of each forward pass when
+        acting, either with TorchScript ("script") or with torch.compile ("compile",
+        PyTorch >= 2). The LSTMs are wrapped so that every block of layers shares the
+        same signature, which lets recurrent networks be compiled as well. The
+        compiled network shares the parameters of the network, so it follows the
+        updates, and it is only used when gradients are disabled.
+
+        Args:
+            backend (str, optional): "script" or "compile". Defaults to "script".
+
+        Raises:
+            ValueError: If the backend is not recognized
+        """
+        blocks, feed_forward_layers = [], []
+        for i, layer in enumerate(self.network):
+            if isinstance(layer, torch.nn.modules.rnn.LSTM):
+                if feed_forward_layers:
+                    blocks.append(FeedForwardBlock(feed_forward_layers))
+                    feed_forward_layers = []
+                blocks.append(RecurrentBlock(layer, i))
+            else:
+                feed_forward_layers.append(layer)
+        if feed_forward_layers:
+            blocks.append(FeedForwardBlock(feed_forward_layers))
+        if backend == "script":
+            compiled_network = torch.jit.script(BlockNetwork(blocks))
+        elif backend == "compile":
+            if not hasattr(torch, "compile"):
+                warnings.warn(
+                    "torch.compile requires PyTorch 2, keeping the eager network",
+                    UserWarning,
+                )
+                return
+            # CUDA graphs (reduce-overhead) replay the whole forward pass in one
+            # launch, but overwrite their outputs at each replay: hidden states that
+            # are kept across steps rule them out for recurrent networks
+            compiled_network = torch.compile(
+                BlockNetwork(blocks),
+                mode="default" if self.recurrent else "reduce-overhead",
+            )
+        else:
+            raise ValueError(f"Compilation backend {backend} not recognized.")
+        # Not registered as a submodule, the eager layers hold the parameters
+        self.__dict__["compiled_network"] = compiled_network
+
+    def __getstate__(self) -> dict:
+        # Compiled networks can't be pickled, they have to be compiled again on loading
+        state = self.__dict__.copy()
+        state["compiled_network"] = None
+        return state
+
+    def initialize_hidden_states(self, batch_size: int = 1):
         hiddens = {}
         for i, layer in enumerate(self.network):
             if isinstance(layer, torch.nn.modules.rnn.LSTM):
                 hiddens[i] = ActorCriticRecurrentNetworks.get_initial_states(
-                    hidden_size=layer.hidden_size, num_layers=layer.num_layers
+                    hidden_size=layer.hidden_size,
+                    num_layers=layer.num_layers,
+                    batch_size=batch_size,
+                    device=layer.weight_hh_l0.device,
                 )
         return hiddens
 
+    @staticmethod
+    def reset_hidden_states(
+        hiddens: Dict[int, torch.Tensor], dones: np.ndarray
+    ) -> Dict[int, torch.Tensor]:
+        """
+        Zero the hidden states of the environments whose episode just ended.
+
+        Args:
+            hiddens (Dict[int, torch.Tensor]): Hidden states of the LSTM layers, batched over environments
+            dones (np.ndarray): Boolean array of shape (num_envs,) flagging the finished episodes
+
+        Returns:
+            Dict[int, torch.Tensor]: The hidden states with the finished environments reset
+        """
+        if not hiddens or not dones.any():
+            return hiddens
+        device = next(iter(hiddens.values()))[0].device
+        mask = torch.as_tensor(~dones, dtype=torch.float32, device=device).view(
+            1, -1, 1
+        )
+        return {
+            i: (h.detach() * mask, c.detach() * mask) for i, (h, c) in hiddens.items()
+        }
+
+    @staticmethod
+    def concatenate_hidden_states(
+        hiddens: List[Dict[int, torch.Tensor]], env_index: int = None
+    ) -> Dict[int, torch.Tensor]:
+        """
+        Concatenate a list of hidden states along the batch dimension, e.g. to
+        evaluate all the steps of a rollout in a single forward pass.
+
+        Args:
+            hiddens (List[Dict[int, torch.Tensor]]): The hidden states to concatenate
+            env_index (int, optional): Only keep the hidden states of this environment. Defaults to None (keep all environments).
+
+        Returns:
+            Dict[int, torch.Tensor]: The concatenated hidden states
+        """
+        if len(hiddens) == 0 or not hiddens[0]:
+            return {}
+        envs = slice(None) if env_index is None else slice(env_index, env_index + 1)
+        return {
+            i: (
+                torch.cat([hidden[i][0][:, envs] for hidden in hiddens], dim=1),
+                torch.cat([hidden[i][1][:, envs] for hidden in hiddens], dim=1),
+            )
+            for i in hiddens[0]
+        }
+
     def init_layers(self) -> torch.nn.Sequential:
         # Device to run computations on
         self.device = "CPU"
@@ -132,34 +369,90 @@ class ActorCriticRecurrentNetworks(nn.Module):
         Returns:
             Tuple[Torch.Tensor, Torch.Tensor]: The processed state and the new hidden state of the LSTM
         """
+        if self.compiled_network is not None and not torch.is_grad_enabled():
+            return self.compiled_network(input, {} if hiddens is None else hiddens)
+        # The given hidden states are left untouched, so that they can be kept (e.g.
+        # in a rollout) without copying them
+        new_hiddens = {}
         for i, layer in enumerate(self.network):
             if isinstance(layer, torch.nn.modules.rnn.LSTM):
                 input = input.view(-1, 1, layer.input_size)
-                hiddens[i] = (hiddens[i][0].detach(), hiddens[i][1].detach())
-                input, hiddens[i] = layer(input, hiddens[i])
+                hidden = (hiddens[i][0].detach(), hiddens[i][1].detach())
+                input, new_hiddens[i] = layer(input, hidden)
             else:
                 input = layer(input)
-        return input, hiddens
+        return input, new_hiddens
 
     @staticmethod
-    def get_initial_states(hidden_size, num_layers):
+    def get_initial_states(hidden_size, num_layers, batch_size=1, device="cpu"):
         h_0, c_0 = None, None
 
         h_0 = torch.zeros(
             (
                 num_layers,
-                1,
+                batch_size,
                 hidden_size,
             ),
             dtype=torch.float,
+            device=device,
         )
 
         c_0 = torch.zeros(
             (
                 num_layers,
-                1,
+                batch_size,
                 hidden_size,
             ),
             dtype=torch.float,
+            device=device,
         )
         return (h_0, c_0)
+
+
+class ActorCriticSharedNetwork(ActorCriticRecurrentNetworks):
+    """
+    Actor and critic sharing the same layers (the trunk), with a policy head and a
+    value head on top. One forward pass gives both the action probabilities and the
+    value of the state.
+    """
+
+    def __init__(self, state_dim, action_dim, architecture, activation="relu"):
+        super(ActorCriticSharedNetwork, self).__init__(
+            state_dim, action_dim, architecture, actor=True, activation=activation
+        )
+
+    def init_layers(self) -> torch.nn.Sequential:
+        self.device = "CPU"
+        activation = get_activation_function(self.activation)
+        layers, trunk_output_size = get_layers_from_architecture(
+            self.state_dim, self.architecture, activation
+        )
+        trunk = nn.Sequential(*layers)
+        trunk.apply(init_weights)
+        self.policy_head = nn.Sequential(
+            nn.Linear(trunk_output_size, self.action_dim), nn.Softmax(dim=-1)
+        )
+        self.policy_head.apply(lambda module: init_weights(m=module, val=0.01))
+        self.value_head = nn.Linear(trunk_output_size, 1)
+        self.value_head.apply(lambda module: init_weights(m=module, val=1))
+        return trunk
+
+    def forward(
+        self,
+        input: torch.Tensor,
+        hiddens: dict = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, Dict[int, torch.Tensor]]:
+        """
+        Shared layers, then the policy and value heads
+
+        Args:
+            state (torch.Tensor): State to be processed
+            hidden (Dict[torch.Tensor]): Hidden states of the LSTMs of the trunk
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor, Dict[int, torch.Tensor]]: The action probabilities, the value and the new hidden states
+        """
+        features, hiddens = super(ActorCriticSharedNetwork, self).forward(
+            input, hiddens
+        )
+        return self.policy_head(features), self.value_head(features), hiddens
@@ -2,7 +2,7 @@ import re
 import numpy as np
 import torch
 import torch.nn as nn
-from typing import List, Union
+from typing import List, Tuple, Union
 import warnings
 
 # helper function to convert numpy arrays to tensors
@@ -28,6 +28,70 @@ def init_weights(m, val=np.sqrt(2)):
         m.bias.data.fill_(0)
 
 
+def get_activation_function(activation_function: str) -> nn.Module:
+    if activation_function.lower() == "relu":
+        return nn.ReLU()
+    elif activation_function.lower() == "tanh":
+        return nn.Tanh()
+    elif activation_function.lower() in ("swish", "silu"):
+        return nn.SiLU()
+    else:
+        raise NotImplementedError(
+            f"No activation function like {activation_function} implemented"
+        )
+
+
+def get_layers_from_architecture(
+    input_shape: int, architecture: List[str], activation: nn.Module
+) -> Tuple[List[nn.Module], int]:
+    """
+    Build the hidden layers (Linear or LSTM, each followed by the activation) described
+    by the architecture.
+
+    Args:
+        input_shape (int): Size of the input of the first layer
+        architecture (List[str]): Architecture in terms of number of neurons per layer, e.g. ["64", "LSTM(32*2)"]
+        activation (nn.Module): The activation function to put after each layer
+
+    Returns:
+        Tuple[List[nn.Module], int]: The layers and the output size of the last one
+    """
+    layers = []
+    for i, layer_description in enumerate(architecture):
+        if "LSTM" in layer_description:
+            recurrent = True
+            LSTM_description = re.search(r"\((.*?)\)", layer_description).group(1)
+            if "*" in LSTM_description:
+                nb_neurons = int(LSTM_description.split("*")[0])
+                nb_layers = int(LSTM_description.split("*")[1])
+            else:
+                nb_neurons = int(LSTM_description)
+                nb_layers = 1
+        else:
+            recurrent = False
+            nb_neurons = int(layer_description)
+        if i == 0:
+            _input_shape = input_shape
+            _output_shape = nb_neurons
+        else:
+            _input_shape = last_layer_neurons
+            _output_shape = nb_neurons
+        last_layer_neurons = nb_neurons
+        if recurrent:
+            layers.append(
+                nn.LSTM(
+                    _input_shape,
+                    _output_shape,
+                    nb_layers,
+                    batch_first=True,
+                )
+            )
+        else:
+            layers.append(nn.Linear(_input_shape, _output_shape))
+        layers.append(activation)
+    return layers, last_layer_neurons
+
+
 def get_network_from_architecture(
     input_shape: int,
     output_shape: int,
@@ -47,16 +111,7 @@ def get_network_from_architecture(
     Returns:
         torch.nn.modules.container.Sequential: The pytorch network
     """
-    if activation_function.lower() == "relu":
-        activation = nn.ReLU()
-    elif activation_function.lower() == "tanh":
-        activation = nn.Tanh()
-    elif activation_function.lower() in ("swish", "silu"):
-        activation = nn.SiLU()
-    else:
-        raise NotImplementedError(
-            f"No activation function like {activation_function} implemented"
-        )
+    activation = get_activation_function(activation_function)
 
     # Trivial cases
     if len(architecture) < 1:
@@ -84,39 +139,9 @@ def get_network_from_architecture(
             return nn.Sequential(*layers)
     # Complex cases
     else:
-        layers = []
-        for i, layer_description in enumerate(architecture):
-            if "LSTM" in layer_description:
-                recurrent = True
-                LSTM_description = re.search(r"\((.*?)\)", layer_description).group(1)
-                if "*" in LSTM_description:
-                    nb_neurons = int(LSTM_description.split("*")[0])
-                    nb_layers = int(LSTM_description.split("*")[1])
-                else:
-                    nb_neurons = int(LSTM_description)
-                    nb_layers = 1
-            else:
-                recurrent = False
-                nb_neurons = int(layer_description)
-            if i == 0:
-                _input_shape = input_shape
-                _output_shape = nb_neurons
-            else:
-                _input_shape = last_layer_neurons
-                _output_shape = nb_neurons
-            last_layer_neurons = nb_neurons
-            if recurrent:
-                layers.append(
-                    nn.LSTM(
-                        _input_shape,
-                        _output_shape,
-                        nb_layers,
-                        batch_first=True,
-                    )
-                )
-            else:
-                layers.append(nn.Linear(_input_shape, _output_shape))
-            layers.append(activation)
+        layers, _output_shape = get_layers_from_architecture(
+            input_shape, architecture, activation
+        )
         _input_shape = _output_shape
         _output_shape = output_shape
         layers.append(nn.Linear(_input_shape, _output_shape))
@@ -132,6 +157,60 @@ def get_network_from_architecture(
         return network
 
 
+@torch.jit.script
+def a2c_losses(
+    log_prob: torch.Tensor,
+    entropy: torch.Tensor,
+    values: torch.Tensor,
+    returns: torch.Tensor,
+    entropy_factor: float,
+    normalize_advantages: bool,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Losses of the A2C update, scripted with TorchScript so that the chain of small
+    element-wise operations runs without going back to Python between them.
+
+    Args:
+        log_prob (torch.Tensor): Log-probabilities of the selected actions, of shape (batch_size,)
+        entropy (torch.Tensor): Entropies of the policy, of shape (batch_size,)
+        values (torch.Tensor): Values of the states, of shape (batch_size,)
+        returns (torch.Tensor): Targets of the critic, of shape (batch_size,)
+        entropy_factor (float): Weight of the entropy bonus in the actor loss
+        normalize_advantages (bool): Whether to standardize the advantages over the batch
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: The actor loss (entropy bonus included), the critic loss and the entropy loss
+    """
+    advantages = returns - values.detach()
+    if normalize_advantages:
+        advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
+    entropy_loss = -entropy.mean()
+    actor_loss = -(log_prob * advantages).mean() + entropy_factor * entropy_loss
+    critic_loss = (returns - values).pow(2).mean()
+    return actor_loss, critic_loss, entropy_loss
+
+
+def categorical_log_prob_and_entropy(
+    probs: torch.Tensor, actions: torch.Tensor, eps: float = 1e-7
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Log-probabilities of the actions and entropies of categorical distributions, from
+    a single log of the probabilities.
+
+    Args:
+        probs (torch.Tensor): Action probabilities, of shape (batch_size, action_dim)
+        actions (torch.Tensor): The actions, of shape (batch_size,)
+        eps (float, optional): Lower bound of the probabilities inside the log. Defaults to 1e-7.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: The log-probabilities and the entropies, both of shape (batch_size,)
+    """
+    log_probs = probs.clamp_min(eps).log()
+    log_prob = log_probs.gather(-1, actions.unsqueeze(-1)).squeeze(-1)
+    entropy = -(probs * log_probs).sum(-1)
+    return log_prob, entropy
+
+
 def compute_KL_divergence(
     old_dist: torch.distributions.Distribution, dist: torch.distributions.Distribution
 ) -> float:
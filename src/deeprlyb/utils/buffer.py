@@ -1,11 +1,27 @@
+from typing import Callable, Optional, Tuple
 import torch
 import numpy as np
 import numpy.typing as npt
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import fftconvolve, lfilter
+
+# Episode length from which lfilter computes MC returns faster than a Python loop
+MC_RETURNS_FILTER_MIN_LENGTH = 32
+# Number of rewards up to which a Python loop computes an n-step return faster than
+# a NumPy dot product
+N_STEP_RETURN_LOOP_MAX_LENGTH = 24
 
 
 class RolloutBuffer:
     def __init__(
-        self, buffer_size: int, gamma: float, n_steps: int, setting: str = "MC"
+        self,
+        buffer_size: int,
+        gamma: float,
+        n_steps: int,
+        setting: str = "MC",
+        obs_shape: Optional[Tuple[int, ...]] = None,
+        fast: bool = True,
+        MC: bool = False,
     ) -> None:
         if buffer_size < 1:
             raise ValueError("Buffer size must be positive")
@@ -17,8 +33,33 @@ class RolloutBuffer:
         self._n_steps = n_steps
         self._buffer_size = buffer_size
         self.gamma = gamma
+        # Default computation of update_advantages, whose returns function is chosen
+        # once here rather than at each update
+        self.fast, self.MC = fast, MC
+        self._returns_fn = self._select_returns_fn(fast, MC)
+
+        self._cap = self.buffer_size + self.n_steps - 1
+
+        # Transitions are stored as contiguous float32/int64 arrays (one row per step)
+        # allocated once, so that they can be handed to PyTorch without any copy
+        if obs_shape is not None:
+            self.observations = np.empty((self._cap, *obs_shape), dtype=np.float32)
+            self.actions = np.empty(self._cap, dtype=np.int64)
+        else:
+            self.observations, self.actions = None, None
+        # Per-step values, allocated once as well, in float32 like the networks: a
+        # single block with one row per step (reward, done, KL divergence, value, log
+        # prob, entropy), the fields being exposed as column views. A step is written
+        # in a single row and the block is zeroed in one call by reset and clean
+        self._store = np.zeros((self._cap, 6), dtype=np.float32)
+        self._arrays = tuple(self._store.T)
+        # Scratch array of the bootstrap values of compute_advantages
+        self._next_values = np.empty(self.buffer_size, dtype=np.float32)
         self.reset()
 
+    def __len__(self) -> int:
+        return self._n
+
     @property
     def n_steps(self) -> float:
         return self._n_steps
@@ -27,42 +68,61 @@ class RolloutBuffer:
     def buffer_size(self) -> int:
         return self._buffer_size
 
+    @property
+    def gamma(self) -> float:
+        return self._gamma
+
+    @gamma.setter
+    def gamma(self, gamma: float) -> None:
+        # The discounts used by the n-step returns and advantages are computed once
+        self._gamma = gamma
+        self._discounts = gamma ** np.arange(self.n_steps, dtype=np.float32)
+        self._gamma_n = gamma**self.n_steps
+
     @property
     def done(self) -> bool:
-        return max(self.dones) == 1
+        # Tracked in add rather than searched for in dones at every step
+        return self._done
 
     @property
     def full(self) -> bool:
-        if (self.__len__ >= self.buffer_size + self.n_steps - 1) or self.done:
-            return True
-        else:
-            return False
+        return self._done or self._n >= self._cap
 
     def reset(self) -> None:
-        buffer_size = self.buffer_size + self.n_steps - 1
-        self.rewards = np.zeros(buffer_size)
-        self.dones = np.zeros(buffer_size)
-        self.KL_divergences = np.zeros(buffer_size)
-        self.values = torch.zeros(buffer_size)
-        self.log_probs = torch.zeros(buffer_size)
-        self.entropies = torch.zeros(buffer_size)
+        self._bind_storage()
+        self._store.fill(0)
         self.advantages = None
         self._returns = None
-        self.__len__ = 0
+        self._done = False
+        self._n = 0
 
     def clean(self) -> None:
-        buffer_size = self.buffer_size + self.n_steps - 1
-        old_rewards = self.rewards[-self.n_steps + 1 :]
-        self.rewards = np.zeros(buffer_size)
-        self.rewards[: self.n_steps - 1] = old_rewards
-        self.dones = np.zeros(buffer_size)
-        self.KL_divergences = np.zeros(buffer_size)
-        self.values = np.zeros(buffer_size)
-        self.log_probs = np.zeros(buffer_size)
-        self.entropies = np.zeros(buffer_size)
+        self._bind_storage()
+        # The last n_steps - 1 steps are needed for the next n-step returns : shift
+        # them in place to the front of the buffer rather than rebuilding it
+        keep = min(self.n_steps - 1, self._n)
+        start = self._n - keep
+        self.rewards[:keep] = self.rewards[start : self._n]
+        self._store[keep:, 0] = 0
+        self._store[:, 1:] = 0
+        if self.observations is not None:
+            self.observations[:keep] = self.observations[start : self._n]
+            self.actions[:keep] = self.actions[start : self._n]
         self.advantages = None
         self._returns = None
-        self.__len__ = self.n_steps - 1
+        self._done = False
+        self._n = keep
+
+    def _bind_storage(self) -> None:
+        # update_advantages (MC) rebinds the attributes to slices of the storage
+        (
+            self.rewards,
+            self.dones,
+            self.KL_divergences,
+            self.values,
+            self.log_probs,
+            self.entropies,
+        ) = self._arrays
 
     def add(
         self,
@@ -72,35 +132,123 @@ class RolloutBuffer:
         log_prob: float,
         entropy: float,
         KL_divergence: float,
+        obs: Optional[np.ndarray] = None,
+        action: Optional[int] = None,
     ) -> None:
-        if self.full:
+        # Same check as full, without the property lookup at every step
+        if self._done or self._n >= self._cap:
             raise ValueError("Buffer is already full, cannot add anymore")
-        self.dones[self.__len__] = done
-        self.values[self.__len__] = value
-        self.log_probs[self.__len__] = log_prob
-        self.entropies[self.__len__] = entropy
-        self.KL_divergences[self.__len__] = KL_divergence
-        self.rewards[self.__len__] = reward
-        self.__len__ += 1
+        if obs is not None:
+            self.observations[self._n] = obs
+            self.actions[self._n] = action
+        self.dones[self._n] = done
+        self.values[self._n] = value
+        self.log_probs[self._n] = log_prob
+        self.entropies[self._n] = entropy
+        self.KL_divergences[self._n] = KL_divergence
+        self.rewards[self._n] = reward
+        if done:
+            self._done = True
+        self._n += 1
+
+    def add_many(
+        self,
+        steps: np.ndarray,
+        observations: Optional[np.ndarray] = None,
+        actions: Optional[np.ndarray] = None,
+    ) -> None:
+        """
+        Add several consecutive steps at once, copying them into the storage in a
+        single call instead of calling add for each step.
+
+        Args:
+            steps (np.ndarray): Steps of shape (k, 6), each row being (reward, done, KL divergence, value, log prob, entropy)
+            observations (Optional[np.ndarray], optional): Observations of the steps, of shape (k, *obs_shape). Defaults to None.
+            actions (Optional[np.ndarray], optional): Actions of the steps, of shape (k,). Defaults to None.
+
+        Raises:
+            ValueError: If the steps don't fit in the buffer, or follow the end of an episode
+        """
+        k = len(steps)
+        if self._done or self._n + k > self._cap:
+            raise ValueError("Not enough room left in the buffer for the steps")
+        dones = steps[:, 1]
+        if dones[:-1].any():
+            raise ValueError("Steps cannot follow the end of an episode")
+        if observations is not None:
+            self.observations[self._n : self._n + k] = observations
+            self.actions[self._n : self._n + k] = actions
+        self._store[self._n : self._n + k] = steps
+        if k > 0 and dones[-1]:
+            self._done = True
+        self._n += k
 
     @staticmethod
-    def compute_n_step_return(rewards: npt.NDArray[np.float64], gamma: float) -> float:
-        # return reduce(lambda a, b: gamma * a + b, reversed(rewards)) -> less efficient somehow
-        n_step_return = 0
-        for reward in reversed(rewards):
-            n_step_return = reward + gamma * n_step_return
-        return n_step_return
+    def compute_n_step_return(
+        rewards: npt.NDArray[np.float32],
+        gamma: float,
+        dones: npt.NDArray[np.float32] = None,
+    ) -> float:
+        # Horner's rule, going backwards : G = r_k + gamma * (1 - done_k) * G. Few
+        # rewards are summed faster by a plain loop than with any NumPy call
+        if len(rewards) <= N_STEP_RETURN_LOOP_MAX_LENGTH:
+            if isinstance(rewards, np.ndarray):
+                rewards = rewards.tolist()
+            G = 0.0
+            if dones is None:
+                for reward in reversed(rewards):
+                    G = reward + gamma * G
+            else:
+                if isinstance(dones, np.ndarray):
+                    dones = dones.tolist()
+                for reward, done in zip(reversed(rewards), reversed(dones)):
+                    G = reward + gamma * (1 - done) * G
+            return float(G)
+        discounts = gamma ** np.arange(len(rewards))
+        if dones is not None:
+            # Rewards following the end of the episode don't belong to this return
+            alive = np.cumprod(1.0 - np.asarray(dones[:-1], dtype=np.float64))
+            discounts[1:] *= alive
+        return float(np.dot(np.asarray(rewards, dtype=np.float64), discounts))
 
     @staticmethod
-    def compute_MC_returns(rewards: npt.NDArray[np.float64], gamma: float) -> float:
-        # return reduce(lambda a, b: gamma * a + b, reversed(rewards)) -> less efficient somehow
-        MC_returns = []
-        cum_return = 0
-        for reward in reversed(rewards):
-            cum_return = reward + gamma * cum_return
-            MC_returns.append(cum_return)
-        MC_returns = MC_returns[::-1]
-        return MC_returns
+    def compute_MC_returns(
+        rewards: npt.NDArray[np.float32], gamma: float
+    ) -> np.ndarray:
+        # G_t = r_t + gamma * G_{t+1} is a first-order linear filter over the reversed
+        # rewards, computed in a single C pass by lfilter (then made contiguous again,
+        # as torch doesn't take negative strides). Short episodes don't make up for
+        # lfilter's call overhead and are computed with a plain loop
+        if len(rewards) < MC_RETURNS_FILTER_MIN_LENGTH:
+            MC_returns = np.empty(len(rewards), dtype=np.float32)
+            cum_return = 0.0
+            for i in range(len(rewards) - 1, -1, -1):
+                cum_return = rewards[i] + gamma * cum_return
+                MC_returns[i] = cum_return
+            return MC_returns
+        rewards = np.asarray(rewards, dtype=np.float32)
+        # float32 coefficients, for lfilter to compute in float32 as well
+        b, a = np.ones(1, dtype=np.float32), np.array([1.0, -gamma], dtype=np.float32)
+        return np.ascontiguousarray(lfilter(b, a, rewards[::-1])[::-1])
+
+    @staticmethod
+    def compute_bootstrapped_returns(
+        rewards: npt.NDArray[np.float32],
+        dones: npt.NDArray[np.float32],
+        last_values: npt.NDArray[np.float32],
+        gamma: float,
+    ) -> np.ndarray:
+        """
+        Returns of a rollout of shape (n_steps, num_envs), bootstrapped on the values
+        of the observations following the rollout. Returns don't propagate through
+        the end of an episode.
+        """
+        returns = np.zeros(rewards.shape, dtype=np.float32)
+        next_return = last_values
+        for step in reversed(range(len(rewards))):
+            next_return = rewards[step] + gamma * (1 - dones[step]) * next_return
+            returns[step] = next_return
+        return returns
 
     @staticmethod
     def compute_next_return(
@@ -110,106 +258,164 @@ class RolloutBuffer:
 
     @staticmethod
     def compute_all_n_step_returns(
-        rewards: npt.NDArray[np.float64],
+        rewards: npt.NDArray[np.float32],
         gamma: float,
         buffer_size: int,
         n_steps: int,
-    ) -> list:
-        returns = []
-        for j in range(buffer_size):
-            rewards_list = rewards[j : min(j + n_steps, len(rewards))]
-            returns.append(RolloutBuffer.compute_n_step_return(rewards_list, gamma))
-        return returns
+        dones: npt.NDArray[np.float32] = None,
+        discounts: npt.NDArray[np.float32] = None,
+    ) -> np.ndarray:
+        """
+        n-step returns starting at each of the buffer_size first steps, rewards past
+        the end of the buffer counting as zeros. Without episode ends, this is the
+        correlation of the rewards with the discounts (gamma ** np.arange(n_steps),
+        computed if not given); with episode ends, rewards following one are masked
+        out of each window.
+        """
+        length = buffer_size + n_steps - 1
+        padded_rewards = np.zeros(length, dtype=np.float32)
+        rewards = np.asarray(rewards, dtype=np.float32)[:length]
+        padded_rewards[: len(rewards)] = rewards
+        if discounts is None:
+            discounts = gamma ** np.arange(n_steps, dtype=np.float32)
+        if dones is None or not np.any(dones):
+            return np.convolve(padded_rewards, discounts[::-1], mode="valid")
+        padded_dones = np.zeros(length, dtype=np.float32)
+        dones = np.asarray(dones, dtype=np.float32)[:length]
+        padded_dones[: len(dones)] = dones
+        reward_windows = sliding_window_view(padded_rewards, n_steps)
+        done_windows = sliding_window_view(padded_dones, n_steps)
+        # A reward belongs to the return if no episode ended before it in the window
+        alive = np.ones((buffer_size, n_steps), dtype=np.float32)
+        alive[:, 1:] = np.cumprod(1.0 - done_windows[:, :-1], axis=1)
+        return (reward_windows * alive) @ discounts
 
     @staticmethod
     def compute_returns(
-        rewards: npt.NDArray[np.float64],
+        rewards: npt.NDArray[np.float32],
         gamma: float,
         buffer_size: int,
         n_steps: int,
+        discounts: npt.NDArray[np.float32] = None,
     ) -> np.ndarray:
+        """
+        n-step returns starting at each of the buffer_size first steps, ignoring
+        episode ends. The rewards are correlated with the discounts in a single
+        direct convolution, without the division by gamma of the running-sum
+        recurrence (compute_next_return), which amplifies rounding errors. The rewards
+        are only copied into a zero-padded array when shorter than the buffer.
+        """
+        length = buffer_size + n_steps - 1
+        rewards = np.asarray(rewards, dtype=np.float32)
+        if len(rewards) < length:
+            padded_rewards = np.zeros(length, dtype=np.float32)
+            padded_rewards[: len(rewards)] = rewards
+            rewards = padded_rewards
+        if discounts is None:
+            discounts = gamma ** np.arange(n_steps, dtype=np.float32)
+        return np.convolve(rewards[:length], discounts[::-1], mode="valid")
 
-        returns = []
+    @staticmethod
+    def compute_returns_batched(
+        rewards: npt.NDArray[np.float32],
+        gamma: float,
+        buffer_size: int,
+        n_steps: int,
+        discounts: npt.NDArray[np.float32] = None,
+    ) -> np.ndarray:
+        """
+        n-step returns of several trajectories at once (one per environment), as
+        compute_returns does for a single one : the rewards of shape (num_envs, T)
+        are correlated with the discounts along the time axis in a single FFT
+        convolution, without looping over the environments.
 
-        # Compute initial return
-        G_0 = RolloutBuffer.compute_n_step_return(rewards[0 : 0 + n_steps], gamma)
-        returns.append(G_0)
-        for i in range(buffer_size - 1):
-            new_return = RolloutBuffer.compute_next_return(
-                returns[i], rewards[i], rewards[i + n_steps], gamma, n_steps - 1
-            )
-            returns.append(new_return)
+        Args:
+            rewards (npt.NDArray[np.float32]): Rewards of shape (num_envs, T)
+            gamma (float): Discount factor
+            buffer_size (int): Number of returns to compute per environment
+            n_steps (int): Number of rewards per return
+            discounts (npt.NDArray[np.float32], optional): gamma ** np.arange(n_steps). Computed if not given. Defaults to None.
 
-        returns = np.array(returns)
-        return returns
+        Returns:
+            np.ndarray: Returns of shape (num_envs, buffer_size)
+        """
+        length = buffer_size + n_steps - 1
+        rewards = np.asarray(rewards, dtype=np.float32)[:, :length]
+        padded_rewards = np.zeros((len(rewards), length), dtype=np.float32)
+        padded_rewards[:, : rewards.shape[1]] = rewards
+        if discounts is None:
+            discounts = gamma ** np.arange(n_steps, dtype=np.float32)
+        return fftconvolve(
+            padded_rewards, discounts[np.newaxis, ::-1], mode="valid", axes=1
+        )
 
     @staticmethod
     def compute_advantages(
-        returns: npt.NDArray[np.float64],
-        values: torch.Tensor,
-        dones: npt.NDArray[np.float64],
+        returns: npt.NDArray[np.float32],
+        values: npt.NDArray[np.float32],
+        dones: npt.NDArray[np.float32],
         gamma: float,
         last_val: float,
         n_steps: int,
+        gamma_n: float = None,
+        next_values: npt.NDArray[np.float32] = None,
     ) -> np.ndarray:
-
-        next_values = values[n_steps:]
-        next_values = np.append(next_values, last_val)
-
-        if n_steps > 0:
-            return [
-                returns[i]
-                + (1 - dones[i]) * (gamma**n_steps) * next_values[i]
-                - values[i]
-                for i in range(len(values) - n_steps + 1)
-            ]
-        else:
+        if n_steps <= 0:
             raise ValueError(f"Invalid steps number : {n_steps}")
+        # One advantage per step with a full n-step window, bootstrapped from the value
+        # n steps later (or last_val past the end of the buffer), gathered in the
+        # next_values scratch array if one is given
+        length = len(values) - n_steps + 1
+        values = np.asarray(values)
+        if next_values is None:
+            next_values = np.empty(length, dtype=values.dtype)
+        next_values = next_values[:length]
+        next_values[:-1] = values[n_steps:]
+        next_values[-1] = last_val
+        if gamma_n is None:
+            gamma_n = gamma**n_steps
+        return (
+            np.asarray(returns[:length])
+            + (1 - np.asarray(dones[:length])) * gamma_n * next_values
+            - values[:length]
+        )
 
     @staticmethod
     def compute_MC_advantages(
-        returns: npt.NDArray[np.float64],
-        values: torch.Tensor,
+        returns: npt.NDArray[np.float32],
+        values: npt.NDArray[np.float32],
     ) -> torch.Tensor:
-        return torch.sub(torch.tensor(returns), values)
+        # Converted to a tensor once, sharing the memory of the float32 advantages
+        return torch.from_numpy(
+            np.subtract(returns, values, dtype=np.float32, casting="same_kind")
+        )
 
     def update_advantages(
-        self, last_val: float = None, fast: bool = True, MC: bool = False
+        self, last_val: float = None, fast: bool = None, MC: bool = None
     ) -> None:
         """Wrapper of static method compute_returns_and_advantages
 
         Args:
             last_val (float): The last value computed by the value network
+            fast (bool, optional): Use compute_returns (for n_steps > 2). Defaults to None (the buffer's).
+            MC (bool, optional): Use Monte-Carlo returns. Defaults to None (the buffer's).
         """
-        if (self.n_steps > 2) and fast:
-            # Faster for high number of steps (complexity constant with n-steps)
-            self._returns = RolloutBuffer.compute_returns(
-                self.rewards,
-                self.gamma,
-                self.buffer_size,
-                self.n_steps,
-            )
-        elif MC:
-            self._returns = RolloutBuffer.compute_MC_returns(
-                self.rewards,
-                self.gamma,
-            )
+        if fast is None and MC is None:
+            returns_fn, MC = self._returns_fn, self.MC
         else:
-            # Faster for low number of steps
-            self._returns = RolloutBuffer.compute_all_n_step_returns(
-                self.rewards,
-                self.gamma,
-                self.buffer_size,
-                self.n_steps,
-            )
+            fast = self.fast if fast is None else fast
+            MC = self.MC if MC is None else MC
+            returns_fn = self._select_returns_fn(fast, MC)
+        self._returns = returns_fn()
         if MC:
             self.advantages = RolloutBuffer.compute_MC_advantages(
                 self._returns,
                 self.values,
             )
-            self.advantages = self.advantages[: self.__len__]
-            self.log_probs = self.log_probs[: self.__len__]
-            # print("values", self.values[: self.__len__])
+            self.advantages = self.advantages[: self._n]
+            self.log_probs = self.log_probs[: self._n]
+            self.entropies = self.entropies[: self._n]
+            # print("values", self.values[: self._n])
             # print("advantages", self.advantages)
         else:
             self.advantages = RolloutBuffer.compute_advantages(
@@ -219,8 +425,37 @@ class RolloutBuffer:
                 self.gamma,
                 last_val,
                 self.n_steps,
+                self._gamma_n,
+                self._next_values,
             )
 
+    def _select_returns_fn(self, fast: bool, MC: bool) -> Callable[[], np.ndarray]:
+        if (self.n_steps > 2) and fast:
+            # Plain convolution, ignoring the episode ends
+            return self._fast_returns
+        elif MC:
+            return self._MC_returns
+        # Convolution masking the rewards following an episode end
+        return self._n_step_returns
+
+    def _fast_returns(self) -> np.ndarray:
+        return RolloutBuffer.compute_returns(
+            self.rewards, self.gamma, self.buffer_size, self.n_steps, self._discounts
+        )
+
+    def _MC_returns(self) -> np.ndarray:
+        return RolloutBuffer.compute_MC_returns(self.rewards, self.gamma)
+
+    def _n_step_returns(self) -> np.ndarray:
+        return RolloutBuffer.compute_all_n_step_returns(
+            self.rewards,
+            self.gamma,
+            self.buffer_size,
+            self.n_steps,
+            self.dones,
+            self._discounts,
+        )
+
     def show(self) -> None:
         print("REWARDS", self.rewards)
         print("VALUES", self.values)
@@ -231,8 +466,18 @@ class RolloutBuffer:
         if self.advantages is not None:
             print("ADVANTAGES", self.advantages)
 
+    def get_transitions(self) -> Tuple[np.ndarray, np.ndarray]:
+        return self.observations[: self._n], self.actions[: self._n]
+
     def get_steps(self) -> tuple:
-        return self.advantages, self.log_probs, self.entropies, self.KL_divergences
+        # The steps are stored in NumPy arrays and only turned into tensors for the
+        # loss computation, as views sharing their memory (no copy)
+        return (
+            torch.as_tensor(self.advantages),
+            torch.from_numpy(self.log_probs),
+            torch.from_numpy(self.entropies),
+            torch.from_numpy(self.KL_divergences),
+        )
 
     def get_steps_list(self) -> None:
         for i in range(len(self.advantages)):
@@ -241,9 +486,15 @@ class RolloutBuffer:
             ], self.KL_divergences[i]
 
     def clear(self) -> None:
-        self.rewards = self.rewards[self.buffer_size :]
-        self.dones = self.dones[self.buffer_size :]
-        self.KL_divergences = self.KL_divergences[self.buffer_size :]
-        self.values = self.values[self.buffer_size :]
-        self.log_probs = self.log_probs[self.buffer_size :]
-        self.entropies = self.entropies[self.buffer_size :]
+        # Drop the buffer_size first steps by moving the remaining ones (at most
+        # n_steps - 1) to the front of the storage, in place : the buffer keeps its
+        # full capacity and nothing is reallocated
+        self._bind_storage()
+        keep = max(self._n - self.buffer_size, 0)
+        self._store[:keep] = self._store[self.buffer_size : self._n]
+        self._store[keep:] = 0
+        if self.observations is not None:
+            self.observations[:keep] = self.observations[self.buffer_size : self._n]
+            self.actions[:keep] = self.actions[self.buffer_size : self._n]
+        self._done = bool(self.dones[:keep].any())
+        self._n = keep
@@ -2,8 +2,48 @@ import os
 import argparse
 import configparser
 import platform
+from functools import lru_cache
+from typing import Dict, Optional
 import torch
 
+# Probed once per process rather than at each configuration read
+if torch.cuda.is_available():
+    GPU_NAME = torch.cuda.get_device_name(0)
+else:
+    GPU_NAME = "No GPU"
+try:
+    CPU_NAME = platform.processor()
+except:
+    print("Couldn't get processor name, using generic name instead")
+    CPU_NAME = "CPU"
+
+
+@lru_cache(maxsize=8)
+def _read_ini(config_file: str, mtime: Optional[float]) -> Dict[str, Dict[str, str]]:
+    """
+    Parse a configuration file into raw (not interpolated) sections. Cached on the
+    file's modification time, so that a file is only parsed again once modified.
+
+    Args:
+        config_file (str): Path of the .ini file
+        mtime (Optional[float]): Modification time of the file (None if missing)
+
+    Returns:
+        Dict[str, Dict[str, str]]: The options of each section
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    defaults = dict(config.defaults())
+    sections = {"DEFAULT": defaults}
+    for section in config.sections():
+        # Options inherited from DEFAULT are left out, those overriding it are kept
+        sections[section] = {
+            key: value
+            for key, value in config.items(section, raw=True)
+            if key not in defaults or value != defaults[key]
+        }
+    return sections
+
 
 def read_config(file=None) -> configparser.ConfigParser:
     if file is None:
@@ -26,19 +66,12 @@ def read_config(file=None) -> configparser.ConfigParser:
             f'Configuration file {config_file} is in the {config_file.split(".")[-1]} extension, should be .ini'
         )
     try:
+        mtime = os.path.getmtime(config_file) if os.path.exists(config_file) else None
+        # A fresh parser each time, as the configuration is modified downstream
         config = configparser.ConfigParser()
-        config.read(config_file)
+        config.read_dict(_read_ini(config_file, mtime))
     except:
         raise OSError(f"Config file {config_file} is impossible to read")
-    if torch.cuda.is_available():
-        GPU_NAME = torch.cuda.get_device_name(0)
-    else:
-        GPU_NAME = "No GPU"
-    try:
-        CPU_NAME = platform.processor()
-    except:
-        print("Couldn't get processor name, using generic name instead")
-        CPU_NAME = "CPU"
     config["HARDWARE"]["GPU_name"] = GPU_NAME
     config["HARDWARE"]["CPU_name"] = CPU_NAME
     return config
@@ -0,0 +1,30 @@
+import gym
+
+
+def make_vec_env(
+    env_id: str, num_envs: int, vectorization: str = "sync"
+) -> gym.vector.VectorEnv:
+    """
+    Create a vector environment of num_envs copies of the environment. Cheap
+    environments are faster to step sequentially in the main process ("sync"),
+    expensive ones benefit from running each in its own subprocess ("async"), with
+    observations written in shared memory rather than pickled at each step.
+
+    Args:
+        env_id (str): Gym id of the environment
+        num_envs (int): Number of environments to step in parallel
+        vectorization (str, optional): "sync" or "async". Defaults to "sync".
+
+    Raises:
+        ValueError: If the vectorization mode is not recognized
+
+    Returns:
+        gym.vector.VectorEnv: The vector environment
+    """
+    env_fns = [lambda: gym.make(env_id) for _ in range(num_envs)]
+    if vectorization == "async":
+        return gym.vector.AsyncVectorEnv(env_fns, shared_memory=True)
+    elif vectorization == "sync":
+        return gym.vector.SyncVectorEnv(env_fns)
+    else:
+        raise ValueError(f"Vectorization mode {vectorization} not recognized.")
@@ -8,6 +8,33 @@ import pickle
 from deeprlyb.network.utils import t
 
 
+def welford_update(
+    mean: np.ndarray,
+    M2: np.ndarray,
+    count: int,
+    new_value: np.ndarray,
+    out: np.ndarray = None,
+) -> np.ndarray:
+    """
+    Update the running mean and sum of squared differences in place with a new sample.
+
+    Args:
+        mean (np.ndarray): The running mean, updated in place
+        M2 (np.ndarray): The running sum of squared differences, updated in place
+        count (int): The number of samples seen, including the new one
+        new_value (np.ndarray): The new sample
+        out (np.ndarray, optional): Array to write the returned deviation in. Defaults to None (new array).
+
+    Returns:
+        np.ndarray: The deviation of the sample from the updated mean
+    """
+    delta = new_value - mean
+    mean += delta / count
+    deviation = np.subtract(new_value, mean, out=out)
+    M2 += delta * deviation
+    return deviation
+
+
 class SimpleStandardizer:
     def __init__(
         self,
@@ -39,23 +66,62 @@ class SimpleStandardizer:
     def partial_fit(self, newValue: npt.NDArray[np.float64]) -> None:
         # Welfor's online algorithm : https://en.m.wikipedia.org/wiki/Algorithms_for_calculating_variance
         self._count += 1
+        self.check_shape(newValue)
+        welford_update(self.mean, self.M2, self._count, newValue)
+        self.update_std()
+
+    def partial_fit_transform(
+        self, newValue: npt.NDArray[np.float64], out: np.ndarray = None
+    ) -> np.ndarray:
+        """
+        Update the running statistics with the value, then standardize it with the
+        updated statistics. The deviation from the updated mean computed by the
+        Welford update is reused as the centered value, so that the value is only
+        read once.
+
+        Args:
+            newValue (npt.NDArray[np.float64]): The value to fit and standardize
+            out (np.ndarray, optional): Preallocated array to write the result in. Defaults to None (new array).
+
+        Returns:
+            np.ndarray: The standardized value
+        """
+        self._count += 1
+        self.check_shape(newValue)
+        if out is None:
+            out = np.empty(self._shape)
+        deviation = welford_update(self.mean, self.M2, self._count, newValue, out=out)
+        self.update_std()
+        self.std[self.std == 0.0] = 1
+        if self.shift_mean:
+            deviation /= self.std
+        else:
+            np.divide(newValue, self.std, out=deviation)
+        if self.clip:
+            np.clip(
+                deviation,
+                self.clipping_range[0],
+                self.clipping_range[1],
+                out=deviation,
+            )
+        return deviation
+
+    def check_shape(self, newValue: np.ndarray) -> None:
+        # Statistics are allocated with the shape of the first sample
         if self.mean is None:
-            self.mean = newValue
-            self.std = np.zeros(len(newValue))
-            self.M2 = np.zeros(len(newValue))
             self._shape = newValue.shape
-        else:
-            if self._shape != newValue.shape:
-                raise ValueError(
-                    f"The shape of samples has changed ({self._shape} to {newValue.shape})"
-                )
-        delta = newValue - self.mean
-        self.mean = self.mean + (delta / self._count)
-        delta2 = newValue - self.mean
-        self.M2 += np.multiply(delta, delta2)
+            self.mean = np.zeros(self._shape)
+            self.std = np.zeros(self._shape)
+            self.M2 = np.zeros(self._shape)
+        elif self._shape != newValue.shape:
+            raise ValueError(
+                f"The shape of samples has changed ({self._shape} to {newValue.shape})"
+            )
+
+    def update_std(self) -> None:
         if self._count >= 2:
-            self.std = np.sqrt(self.M2 / self._count)
-            self.std = np.nan_to_num(self.std, nan=1)
+            np.sqrt(self.M2 / self._count, out=self.std)
+            np.nan_to_num(self.std, copy=False, nan=1)
 
     @staticmethod
     def numpy_transform(
@@ -65,15 +131,18 @@ class SimpleStandardizer:
         shift_mean: bool = True,
         clip: bool = False,
         clipping_range: tuple = None,
+        out: np.ndarray = None,
     ) -> np.ndarray:
+        # Computed in place in out when given, in a new float64 array otherwise
+        dtype = np.float64 if out is None else None
         if shift_mean:
-            new_value = (value - mean) / std
+            new_value = np.subtract(value, mean, out=out, dtype=dtype)
+            new_value /= std
         else:
-            new_value = value / std
+            new_value = np.divide(value, std, out=out, dtype=dtype)
         if clip:
-            return np.clip(new_value, clipping_range[0], clipping_range[1])
-        else:
-            return new_value
+            np.clip(new_value, clipping_range[0], clipping_range[1], out=new_value)
+        return new_value
 
     @staticmethod
     def pytorch_transform(
@@ -95,8 +164,18 @@ class SimpleStandardizer:
             return new_value
 
     def transform(
-        self, value: Union[np.ndarray, torch.Tensor]
+        self, value: Union[np.ndarray, torch.Tensor], out: np.ndarray = None
     ) -> Union[np.ndarray, torch.Tensor]:
+        """
+        Standardize the value with the running statistics.
+
+        Args:
+            value (Union[np.ndarray, torch.Tensor]): The value to standardize
+            out (np.ndarray, optional): Preallocated array to write numpy results in (it can be value itself). Defaults to None (new array).
+
+        Returns:
+            Union[np.ndarray, torch.Tensor]: The standardized value
+        """
         std_temp = self.std
         std_temp[std_temp == 0.0] = 1
         if isinstance(value, np.ndarray):
@@ -107,6 +186,7 @@ class SimpleStandardizer:
                 self.shift_mean,
                 self.clip,
                 self.clipping_range,
+                out=out,
             )
         elif isinstance(value, torch.Tensor):
             return self.pytorch_transform(
@@ -125,7 +205,8 @@ class SimpleStandardizer:
     ) -> None:
         os.makedirs(path, exist_ok=True)
         with open(os.path.join(path, name + ".pkl"), "wb") as file:
-            pickle.dump(self, file)
+            # Protocol 5 serializes the numpy statistics from their buffers directly
+            pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
 
     def load(self, path: Union[str, pathlib.Path], name: str = "standardizer") -> None:
         with open(os.path.join(path, name + ".pkl"), "rb") as file:
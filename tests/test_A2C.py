@@ -1,8 +1,13 @@
 import os
 import gym
 import shutil
+import pickle
 import unittest
+import torch
+import numpy as np
 from deeprlyb.agents.A2C import A2C
+from deeprlyb.network.utils import t
+from deeprlyb.utils.buffer import RolloutBuffer
 from deeprlyb.utils.config import read_config
 
 
@@ -25,6 +30,7 @@ class TestA2C(unittest.TestCase):
         critic_hidden = agent.network.critic.initialize_hidden_states()
         for i in range(10):
             action, actor_hidden = agent.select_action(obs, actor_hidden)[:2]
+            self.assertIsInstance(action, int)
             value, critic_hidden = agent.network.get_value(obs, critic_hidden)
             obs, reward, done, _ = env.step(action)
             if done:
@@ -50,17 +56,23 @@ class TestA2C(unittest.TestCase):
         agent = A2C(env, config)
         obs = env.reset()
         actor_hidden = agent.network.actor.initialize_hidden_states()
-        critic_hidden = agent.network.critic.initialize_hidden_states()
+        states, actions, rewards = [], [], []
         for i in range(10):
             action, actor_hidden, loss_params = agent.select_action(obs, actor_hidden)
-            value, critic_hidden = agent.network.get_value(obs, critic_hidden)
+            states.append(obs)
+            actions.append(action)
             obs, reward, done, _ = env.step(action)
-            next_value, critic_hidden = agent.network.get_value(obs, critic_hidden)
-            advantage = reward + next_value - value
-            agent.network.update_policy(advantage, *loss_params)
-
+            rewards.append(reward)
             if done:
                 break
+        returns = RolloutBuffer.compute_MC_returns(rewards, 0.99)
+        agent.network.update_policy(
+            np.array(states), np.array(actions), np.array(returns)
+        )
+        # Losses are logged every log_every updates
+        self.assertEqual(len(agent.network.metrics["actor loss"]), 1)
+        agent.network.flush_metrics()
+        self.assertFalse(agent.network.metrics)
 
     def test_train_test(self) -> None:
         env = gym.make("CartPole-v1")
@@ -78,6 +90,133 @@ class TestA2C(unittest.TestCase):
         agent.train_MC(env, 1e3)
         agent.test(env, nb_episodes=10, render=False)
 
+    def test_train_vectorized(self) -> None:
+        env = gym.vector.SyncVectorEnv(
+            [lambda: gym.make("CartPole-v1") for _ in range(2)]
+        )
+        dir = os.path.dirname(__file__)
+        config_file = os.path.join(dir, "config.ini")
+        config = read_config(config_file)
+        agent = A2C(env, config)
+        self.assertEqual(agent.num_envs, 2)
+        self.assertEqual(agent.obs_shape, (4,))
+        agent.train_TD0(env, 1e3)
+        del agent
+
+        agent = A2C(env, config)
+        agent.train_MC(env, 1e3)
+        agent.test(gym.make("CartPole-v1"), nb_episodes=2, render=False)
+
+        config["NETWORKS"]["actor_nn_architecture"] = "[16,LSTM(8)]"
+        config["NETWORKS"]["critic_nn_architecture"] = "[16,LSTM(8)]"
+        agent = A2C(env, config)
+        agent.train_TD0(env, 1e3)
+
+        # A single environment is completed with copies up to num_envs
+        env = gym.make("CartPole-v1")
+        config["GLOBAL"]["num_envs"] = "3"
+        agent = A2C(env, config)
+        self.assertEqual(agent.vectorize(env).num_envs, 3)
+        agent.train_TD0(env, 1e3)
+
+        # Environments stepped in subprocesses
+        config["GLOBAL"]["vectorization"] = "async"
+        envs = agent.vectorize(env)
+        self.assertIsInstance(envs, gym.vector.AsyncVectorEnv)
+        agent.train_TD0(envs, 1e3)
+        agent.train_MC(envs, 2e3)
+        # The vector environment is reused by the training calls until closed
+        agent.train_TD0(env, 1e3)
+        self.assertIs(agent.vectorize(env), envs)
+        agent.close()
+        self.assertTrue(envs.closed)
+        self.assertIsNot(agent.vectorize(env), envs)
+        agent.close()
+
+    def test_jit(self) -> None:
+        env = gym.make("CartPole-v1")
+        dir = os.path.dirname(__file__)
+        config_file = os.path.join(dir, "config.ini")
+        config = read_config(config_file)
+        config["HARDWARE"]["jit"] = "True"
+        agent = A2C(env, config)
+        self.assertIsNotNone(agent.network.actor.compiled_network)
+        obs = env.reset()
+        with torch.no_grad():
+            scripted_probs, _ = agent.network.actor(t(obs), {})
+        with torch.enable_grad():
+            probs, _ = agent.network.actor(t(obs), {})
+        self.assertTrue(torch.allclose(scripted_probs, probs))
+        agent.train_TD0(env, 1e3)
+        # Scripted networks are dropped when pickling (i.e. saving) the networks
+        actor = pickle.loads(pickle.dumps(agent.network.actor))
+        self.assertIsNone(actor.compiled_network)
+        with self.assertRaises(ValueError):
+            actor.jit_compile("unknown")
+
+        # Recurrent networks are scripted as well
+        config["NETWORKS"]["actor_nn_architecture"] = "[16,LSTM(8),16]"
+        agent = A2C(env, config)
+        hidden = agent.network.actor.initialize_hidden_states()
+        with torch.no_grad():
+            scripted_probs, scripted_hidden = agent.network.actor(t(obs), hidden)
+        with torch.enable_grad():
+            probs, new_hidden = agent.network.actor(t(obs), hidden)
+        self.assertTrue(torch.allclose(scripted_probs, probs))
+        for i in hidden:
+            self.assertTrue(torch.allclose(scripted_hidden[i][0], new_hidden[i][0]))
+            # The given hidden states are not modified
+            self.assertFalse(hidden[i][0].any())
+        agent.train_TD0(env, 1e3)
+
+    def test_compile(self) -> None:
+        env = gym.make("CartPole-v1")
+        dir = os.path.dirname(__file__)
+        config_file = os.path.join(dir, "config.ini")
+        config = read_config(config_file)
+        config["HARDWARE"]["compile"] = "True"
+        config["NETWORKS"]["actor_nn_architecture"] = "[16,LSTM(8),16]"
+        agent = A2C(env, config)
+        self.assertIsNotNone(agent.network.actor.compiled_network)
+        obs = env.reset()
+        hidden = agent.network.actor.initialize_hidden_states()
+        hiddens = [hidden]
+        for i in range(3):
+            hidden = agent.select_action(obs, hidden)[1]
+            hiddens.append(hidden)
+        # The given hidden states are not modified, each step gets its own
+        for i in hiddens[0]:
+            self.assertFalse(hiddens[0][i][0].any())
+        for previous, next in zip(hiddens[:-1], hiddens[1:]):
+            self.assertIsNot(previous, next)
+            for i in previous:
+                self.assertIsNot(previous[i], next[i])
+        self.assertFalse(torch.equal(hiddens[1][i][0], hiddens[2][i][0]))
+
+    def test_shared_network(self) -> None:
+        env = gym.vector.SyncVectorEnv(
+            [lambda: gym.make("CartPole-v1") for _ in range(2)]
+        )
+        dir = os.path.dirname(__file__)
+        config_file = os.path.join(dir, "config.ini")
+        config = read_config(config_file)
+        config["NETWORKS"]["shared_network"] = "True"
+        agent = A2C(env, config)
+        self.assertIs(agent.network.actor, agent.network.critic)
+        agent.train_TD0(env, 1e3)
+        agent.train_MC(env, 2e3)
+
+        config["NETWORKS"]["actor_nn_architecture"] = "[16,LSTM(8)]"
+        agent = A2C(env, config)
+        obs = env.reset()
+        hidden = agent.network.actor.initialize_hidden_states(2)
+        action, value, actor_hidden, critic_hidden, _ = agent.network.act(
+            obs, hidden, hidden
+        )
+        self.assertEqual(action.shape, (2,))
+        self.assertEqual(value.shape, (2,))
+        agent.train_TD0(env, 1e3)
+
     def test_pre_train(self) -> None:
         env = gym.make("CartPole-v1")
         dir = os.path.dirname(__file__)
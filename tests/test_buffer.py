@@ -1,4 +1,5 @@
 import unittest
+import torch
 import numpy as np
 from deeprlyb.utils.buffer import RolloutBuffer
 import numpy as np
@@ -17,7 +18,12 @@ class TestSimpleStandardizer(unittest.TestCase):
         buffer = RolloutBuffer(buffer_size=5, gamma=0.99, n_steps=5)
         while not buffer.full:
             buffer.add(-1.3, False, 0.3, 0.1, 1e-3, 0.5)
-        self.assertEqual(buffer._n_steps + buffer._buffer_size - 1, buffer.__len__)
+        self.assertEqual(buffer._n_steps + buffer._buffer_size - 1, len(buffer))
+        # Each step is a row of the storage block, the fields being its columns
+        np.testing.assert_array_almost_equal(
+            buffer._store[0], [-1.3, 0, 0.5, 0.3, 0.1, 1e-3]
+        )
+        self.assertEqual(buffer.values[0], buffer._store[0, 3])
         buffer = RolloutBuffer(buffer_size=5, gamma=0.99, n_steps=5)
 
         # check that buffer is full on done
@@ -26,7 +32,69 @@ class TestSimpleStandardizer(unittest.TestCase):
         while not buffer.full:
             buffer.add(-1.3, dones[i], 0.3, 0.1, 1e-3, 0.5)
             i += 1
-        self.assertEqual(3, buffer.__len__)
+        self.assertEqual(3, len(buffer))
+        # and no longer once cleaned
+        buffer.clean()
+        self.assertFalse(buffer.full)
+
+    def test_add_many(self) -> None:
+        buffer = RolloutBuffer(buffer_size=4, gamma=0.99, n_steps=1, obs_shape=(3,))
+        steps = np.array([[-1.3, 0, 0.5, 0.3, 0.1, 1e-3]] * 3, dtype=np.float32)
+        buffer.add_many(steps, np.ones((3, 3)), np.arange(3))
+        self.assertEqual(3, len(buffer))
+        np.testing.assert_array_almost_equal(buffer.values[:3], [0.3] * 3)
+        np.testing.assert_array_equal(buffer.get_transitions()[1], np.arange(3))
+        # Same result as adding the steps one by one
+        other = RolloutBuffer(buffer_size=4, gamma=0.99, n_steps=1)
+        for _ in range(3):
+            other.add(-1.3, False, 0.3, 0.1, 1e-3, 0.5)
+        np.testing.assert_array_equal(buffer._store, other._store)
+        with self.assertRaises(ValueError):
+            buffer.add_many(steps)
+        # The buffer is full after the end of an episode, which must come last
+        buffer.reset()
+        steps[1, 1] = 1
+        with self.assertRaises(ValueError):
+            buffer.add_many(steps)
+        buffer.add_many(steps[:2])
+        self.assertTrue(buffer.full)
+
+    def test_add_transitions(self) -> None:
+        buffer = RolloutBuffer(buffer_size=4, gamma=0.99, n_steps=1, obs_shape=(3,))
+        self.assertEqual(buffer.observations.dtype, np.float32)
+        i = 0
+        while not buffer.full:
+            buffer.add(-1.3, False, 0.3, 0.1, 1e-3, 0.5, obs=np.full(3, i), action=i)
+            i += 1
+        observations, actions = buffer.get_transitions()
+        np.testing.assert_array_equal(observations[:, 0], np.arange(4))
+        np.testing.assert_array_equal(actions, np.arange(4))
+
+    def test_discounts(self) -> None:
+        buffer = RolloutBuffer(buffer_size=5, gamma=0.9, n_steps=3)
+        np.testing.assert_array_almost_equal(buffer._discounts, [1, 0.9, 0.81])
+        self.assertAlmostEqual(buffer._gamma_n, 0.729)
+        # and are updated along with gamma
+        buffer.gamma = 0.5
+        np.testing.assert_array_almost_equal(buffer._discounts, [1, 0.5, 0.25])
+        self.assertAlmostEqual(buffer._gamma_n, 0.125)
+
+    def test_clear(self) -> None:
+        buffer = RolloutBuffer(buffer_size=4, gamma=0.99, n_steps=3, obs_shape=(1,))
+        i = 0
+        while not buffer.full:
+            buffer.add(i, i == 5, 1, 0.1, 1e-3, 0.5, obs=np.full(1, i), action=i)
+            i += 1
+        buffer.clear()
+        # The steps following the first buffer_size ones are moved to the front
+        self.assertEqual(2, len(buffer))
+        np.testing.assert_array_equal(buffer.rewards, [4, 5, 0, 0, 0, 0])
+        np.testing.assert_array_equal(buffer.get_transitions()[1], [4, 5])
+        self.assertTrue(buffer.done)
+        buffer.reset()
+        while not buffer.full:
+            buffer.add(1, False, 1, 0.1, 1e-3, 0.5, obs=np.ones(1), action=0)
+        self.assertEqual(6, len(buffer))
 
     def test_compute_n_step_return(self) -> None:
         rewards_list = [1, 2, 3, 4, 5]
@@ -35,6 +103,103 @@ class TestSimpleStandardizer(unittest.TestCase):
         self.assertAlmostEqual(
             G, 1 + 0.99 * 2 + 0.99**2 * 3 + 0.99**3 * 4 + 0.99**4 * 5
         )
+        # Rewards after the end of the episode are ignored
+        dones = [False, True, False, False, False]
+        G = RolloutBuffer.compute_n_step_return(rewards_list, gamma, dones)
+        self.assertAlmostEqual(G, 1 + 0.99 * 2)
+        # Long windows go through a dot product, short ones through a loop
+        rewards = np.random.rand(40)
+        dones = np.zeros(40)
+        dones[30] = 1
+        self.assertAlmostEqual(
+            RolloutBuffer.compute_n_step_return(rewards, gamma, dones),
+            RolloutBuffer.compute_n_step_return(rewards[:20], gamma)
+            + gamma**20 * RolloutBuffer.compute_n_step_return(rewards[20:31], gamma),
+        )
+
+    def test_compute_all_n_step_returns(self) -> None:
+        rewards = np.random.rand(12)
+        dones = np.zeros(12)
+        for n_steps, done_steps in [(1, []), (4, []), (4, [2, 7]), (12, [5])]:
+            dones[:] = 0
+            dones[done_steps] = 1
+            buffer_size = 12 - n_steps + 1
+            returns = RolloutBuffer.compute_all_n_step_returns(
+                rewards, 0.9, buffer_size, n_steps, dones
+            )
+            expected = [
+                RolloutBuffer.compute_n_step_return(
+                    rewards[j : j + n_steps], 0.9, dones[j : j + n_steps]
+                )
+                for j in range(buffer_size)
+            ]
+            np.testing.assert_array_almost_equal(returns, expected)
+        # Without episode ends, compute_returns gives the same returns
+        rewards = np.random.rand(40)
+        np.testing.assert_array_almost_equal(
+            RolloutBuffer.compute_returns(rewards, 0.9, 32, 9),
+            RolloutBuffer.compute_all_n_step_returns(rewards, 0.9, 32, 9),
+        )
+        # Several trajectories at once
+        rewards = np.random.rand(3, 40)
+        returns = RolloutBuffer.compute_returns_batched(rewards, 0.9, 32, 9)
+        self.assertEqual(returns.shape, (3, 32))
+        for env_rewards, env_returns in zip(rewards, returns):
+            np.testing.assert_array_almost_equal(
+                env_returns, RolloutBuffer.compute_returns(env_rewards, 0.9, 32, 9)
+            )
+        # Rewards past the end of the buffer count as zeros
+        returns = RolloutBuffer.compute_all_n_step_returns([1.0, 1.0], 0.5, 2, 3)
+        np.testing.assert_array_almost_equal(returns, [1.5, 1.0])
+
+    def test_compute_MC_returns(self) -> None:
+        returns = RolloutBuffer.compute_MC_returns([1, 2, 3], 0.9)
+        np.testing.assert_array_almost_equal(
+            returns, [1 + 0.9 * 2 + 0.81 * 3, 2 + 0.9 * 3, 3]
+        )
+        self.assertEqual(len(RolloutBuffer.compute_MC_returns([], 0.9)), 0)
+        # Long episodes go through lfilter, short ones through a loop
+        rewards = np.random.rand(100)
+        # Returns are computed in float32 like the stored rewards, either way
+        for length in (10, 100):
+            self.assertEqual(
+                RolloutBuffer.compute_MC_returns(rewards[:length], 0.9).dtype,
+                np.float32,
+            )
+        np.testing.assert_array_almost_equal(
+            RolloutBuffer.compute_MC_returns(rewards, 0.9)[-10:],
+            RolloutBuffer.compute_MC_returns(rewards[-10:], 0.9),
+        )
+
+    def test_compute_bootstrapped_returns(self) -> None:
+        rewards = np.array([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]])
+        dones = np.array([[False, False], [False, True], [False, False]])
+        last_values = np.array([10.0, 20.0])
+        returns = RolloutBuffer.compute_bootstrapped_returns(
+            rewards, dones, last_values, 0.9
+        )
+        np.testing.assert_array_almost_equal(
+            returns[:, 0],
+            [
+                1 + 0.9 * 3 + 0.81 * 5 + 0.729 * 10,
+                3 + 0.9 * 5 + 0.81 * 10,
+                5 + 0.9 * 10,
+            ],
+        )
+        # The second environment's episode ends at the second step
+        np.testing.assert_array_almost_equal(
+            returns[:, 1], [2 + 0.9 * 4, 4, 6 + 0.9 * 20]
+        )
+        # Returns are linear in the bootstrap values
+        partial_returns = RolloutBuffer.compute_bootstrapped_returns(
+            rewards, dones, np.zeros(2), 0.9
+        )
+        discounts = RolloutBuffer.compute_bootstrapped_returns(
+            np.zeros_like(rewards), dones, np.ones(2), 0.9
+        )
+        np.testing.assert_array_almost_equal(
+            returns, partial_returns + discounts * last_values
+        )
 
     def test_compute_advantages(self) -> None:
         buffer = RolloutBuffer(buffer_size=1, gamma=0.99, n_steps=1)
@@ -50,6 +215,12 @@ class TestSimpleStandardizer(unittest.TestCase):
         while not buffer.full:
             buffer.add(np.random.randint(10), False, 1, 0.1, 1e-3, 0.5)
         buffer.update_advantages(last_val=1, fast=False, MC=True)
+        self.assertEqual(buffer.advantages.dtype, torch.float32)
+        # The steps are handed to the loss as tensors sharing the buffer's memory
+        advantages, log_probs, entropies, KL_divergences = buffer.get_steps()
+        self.assertIsInstance(log_probs, torch.Tensor)
+        log_probs[0] = 2.0
+        self.assertEqual(buffer.log_probs[0], 2.0)
         print(buffer._returns)
         print(buffer.advantages)
         # buffer = RolloutBuffer(buffer_size=2, gamma=0.99, n_steps=2)
@@ -66,6 +237,50 @@ class TestSimpleStandardizer(unittest.TestCase):
         # advantage_1 = returns[0] + (buffer.gamma ** buffer.n_steps) * v_n - v_0
         # np.testing.assert_array_almost_equal(buffer.advantages, advantage_1)
 
+    def test_compute_advantages_values(self) -> None:
+        returns = np.array([1.0, 2.0, 3.0, 4.0])
+        values = np.array([0.5, 1.0, 1.5, 2.0], dtype=np.float32)
+        dones = np.array([0.0, 1.0, 0.0, 0.0])
+        advantages = RolloutBuffer.compute_advantages(
+            returns, values, dones, 0.9, 10.0, 2
+        )
+        # Bootstrapped from the value two steps later, except after an episode end
+        np.testing.assert_array_almost_equal(
+            advantages, [1 + 0.81 * 1.5 - 0.5, 2 - 1, 3 + 0.81 * 10 - 1.5]
+        )
+        # The bootstrap values can be gathered in a preallocated array
+        scratch = np.empty(3, dtype=np.float32)
+        np.testing.assert_array_almost_equal(
+            RolloutBuffer.compute_advantages(
+                returns, values, dones, 0.9, 10.0, 2, next_values=scratch
+            ),
+            advantages,
+        )
+        np.testing.assert_array_equal(scratch, [1.5, 2.0, 10.0])
+        with self.assertRaises(ValueError):
+            RolloutBuffer.compute_advantages(returns, values, dones, 0.9, 10.0, 0)
+
+    def test_update_advantages_defaults(self) -> None:
+        # The computation is chosen at construction, and can be overridden per update
+        rewards = np.random.rand(10)
+        buffers = [
+            RolloutBuffer(buffer_size=10, gamma=0.9, n_steps=1, MC=True),
+            RolloutBuffer(buffer_size=10, gamma=0.9, n_steps=1),
+        ]
+        for buffer in buffers:
+            for reward in rewards:
+                buffer.add(reward, False, 1, 0.1, 1e-3, 0.5)
+        buffers[0].update_advantages()
+        buffers[1].update_advantages(MC=True)
+        np.testing.assert_array_almost_equal(buffers[0]._returns, buffers[1]._returns)
+        np.testing.assert_array_almost_equal(
+            buffers[0]._returns, RolloutBuffer.compute_MC_returns(rewards, 0.9)
+        )
+        buffers[1].update_advantages(last_val=0)
+        np.testing.assert_array_almost_equal(
+            buffers[1]._returns, rewards.astype(np.float32)
+        )
+
     def test_clean(self) -> None:
         buffer = RolloutBuffer(buffer_size=10, gamma=0.99, n_steps=5)
         vals = range(100)
@@ -74,11 +289,40 @@ class TestSimpleStandardizer(unittest.TestCase):
             buffer.add(vals[i], False, 1, 0.1, 1e-3, 0.5)
             i += 1
         buffer.clean()
-        self.assertEqual(buffer.n_steps - 1, buffer.__len__)
+        self.assertEqual(buffer.n_steps - 1, len(buffer))
         while not buffer.full:
             buffer.add(vals[i], False, 1, 0.1, 1e-3, 0.5)
             i += 1
-        self.assertEqual(buffer._n_steps + buffer._buffer_size - 1, buffer.__len__)
+        self.assertEqual(buffer._n_steps + buffer._buffer_size - 1, len(buffer))
+
+        # The last n_steps - 1 steps are moved to the front
+        buffer.clean()
+        np.testing.assert_array_equal(buffer.rewards[:4], vals[i - 4 : i])
+        self.assertFalse(buffer.rewards[4:].any())
+
+        # Nothing to keep for one-step returns
+        buffer = RolloutBuffer(buffer_size=3, gamma=0.99, n_steps=1, obs_shape=(2,))
+        while not buffer.full:
+            buffer.add(1, False, 1, 0.1, 1e-3, 0.5, obs=np.ones(2), action=0)
+        buffer.clean()
+        self.assertEqual(0, len(buffer))
+        self.assertFalse(buffer.rewards.any())
+
+        # The storage is allocated once, and restored after being sliced
+        rewards, values = buffer.rewards, buffer.values
+        while not buffer.full:
+            buffer.add(1, False, 1, 0.1, 1e-3, 0.5, obs=np.ones(2), action=0)
+        buffer.update_advantages(MC=True)
+        buffer.clear()
+        buffer.reset()
+        self.assertIs(rewards, buffer.rewards)
+        self.assertIs(values, buffer.values)
+        self.assertFalse(buffer.values.any())
+        # All the per-step values are float32 arrays, before and after cleaning
+        buffer.clean()
+        for values in (buffer.rewards, buffer.values, buffer.log_probs):
+            self.assertIsInstance(values, np.ndarray)
+            self.assertEqual(values.dtype, np.float32)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+import configparser
+from deeprlyb.utils.config import read_config
+
+
+class TestConfig(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.dir, "config.ini")
+        with open(self.config_file, "w") as file:
+            file.write(
+                "[DEFAULT]\nlr = 1\ngamma = 0.99\n\n"
+                "[NETWORKS]\nlr = 2\n\n[AGENT]\nn_steps = 3\n\n[HARDWARE]\n"
+            )
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.dir)
+
+    def test_read_config(self) -> None:
+        expected = configparser.ConfigParser()
+        expected.read(self.config_file)
+        # Read twice, the second time from the cache
+        for _ in range(2):
+            config = read_config(self.config_file)
+            self.assertEqual(config.sections(), expected.sections())
+            for section in ("NETWORKS", "AGENT"):
+                self.assertEqual(dict(config[section]), dict(expected[section]))
+            # Options overriding DEFAULT are kept
+            self.assertEqual(config["NETWORKS"]["lr"], "2")
+            self.assertEqual(config["AGENT"]["lr"], "1")
+        # Changes to a returned configuration don't reach the cache
+        config["NETWORKS"]["lr"] = "3"
+        self.assertEqual(read_config(self.config_file)["NETWORKS"]["lr"], "2")
+
+    def test_extension(self) -> None:
+        with self.assertRaises(ValueError):
+            read_config(os.path.join(self.dir, "config.txt"))
+
+
+if __name__ == "__main__":
+    unittest.main()
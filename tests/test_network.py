@@ -1,7 +1,12 @@
 import unittest
 import torch
 import numpy as np
-from deeprlyb.network.utils import t, get_network_from_architecture
+from deeprlyb.network.utils import (
+    t,
+    get_network_from_architecture,
+    categorical_log_prob_and_entropy,
+    a2c_losses,
+)
 from deeprlyb.network.network import ActorCriticRecurrentNetworks
 
 
@@ -29,6 +34,35 @@ class TestNetworkUtils(unittest.TestCase):
 
             self.assertEqual(int(len(network) / 2) - 1, len(parsed_archi))
 
+    def test_categorical(self) -> None:
+        probs = torch.softmax(torch.randn(5, 3), dim=-1)
+        actions = torch.tensor([0, 1, 2, 1, 0])
+        dist = torch.distributions.Categorical(probs=probs)
+        log_prob, entropy = categorical_log_prob_and_entropy(probs, actions)
+        self.assertTrue(torch.allclose(log_prob, dist.log_prob(actions), atol=1e-5))
+        self.assertTrue(torch.allclose(entropy, dist.entropy(), atol=1e-5))
+
+    def test_a2c_losses(self) -> None:
+        log_prob, entropy = torch.randn(6), torch.rand(6)
+        values = torch.randn(6, requires_grad=True)
+        returns = torch.randn(6)
+        actor_loss, critic_loss, entropy_loss = a2c_losses(
+            log_prob, entropy, values, returns, 0.1, True
+        )
+        advantages = returns - values.detach()
+        advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
+        self.assertTrue(
+            torch.allclose(
+                actor_loss,
+                -(log_prob * advantages).mean() - 0.1 * entropy.mean(),
+            )
+        )
+        self.assertTrue(torch.allclose(critic_loss, (returns - values).pow(2).mean()))
+        self.assertTrue(torch.allclose(entropy_loss, -entropy.mean()))
+        # The critic loss flows back to the values
+        critic_loss.backward()
+        self.assertIsNotNone(values.grad)
+
     def test_init_and_forward(self) -> None:
         state_dim = 16
         action_dim = 4
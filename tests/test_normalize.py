@@ -33,11 +33,32 @@ class TestSimpleStandardizer(unittest.TestCase):
         self.assertTrue(np.allclose(standardizer.mean, samples.mean(axis=0)))
         self.assertTrue(np.allclose(standardizer.std, samples.std(axis=0)))
 
+        # The running statistics are updated in place, not the samples
+        standardizer = SimpleStandardizer(shift_mean=True)
+        first_sample = np.ones(3)
+        standardizer.partial_fit(first_sample)
+        standardizer.partial_fit(np.zeros(3))
+        np.testing.assert_array_equal(first_sample, np.ones(3))
+
         with self.assertRaises(ValueError):
             standardizer = SimpleStandardizer(shift_mean=True)
             standardizer.partial_fit(np.ones(4))
             standardizer.partial_fit(np.ones(3))
 
+    def test_partial_fit_transform(self) -> None:
+        samples = np.random.randint(10, size=(20, 3))
+        standardizer = SimpleStandardizer(clip=True)
+        fused_standardizer = SimpleStandardizer(clip=True)
+        out = np.empty(3, dtype=np.float32)
+        for sample in samples:
+            standardizer.partial_fit(sample)
+            result = fused_standardizer.partial_fit_transform(sample, out=out)
+            self.assertIs(result, out)
+            self.assertTrue(
+                np.allclose(standardizer.transform(sample), result, atol=1e-6)
+            )
+        self.assertTrue(np.allclose(standardizer.std, fused_standardizer.std))
+
     def test_transform(self) -> None:
         with self.assertRaises(TypeError):
             standardizer = SimpleStandardizer(shift_mean=True)
@@ -50,6 +71,12 @@ class TestSimpleStandardizer(unittest.TestCase):
         self.assertTrue(np.allclose(sample, result))
         self.assertIsInstance(result, np.ndarray)
 
+        # Results can be written into a preallocated array
+        out = np.empty(3, dtype=np.float32)
+        result = standardizer.transform(sample, out=out)
+        self.assertIs(result, out)
+        self.assertTrue(np.allclose(sample, out))
+
     def test_pytorch_transform(self) -> None:
         with self.assertRaises(TypeError):
             standardizer = SimpleStandardizer(shift_mean=True)